@@ -1,5 +1,17 @@
 import dash
 import os
+import importlib
+import plotly
+from flask import Response, abort
+
+from core.data_utils import get_shapes_geojson_string
+
+# orjson writes json a lot faster than the standard json library. It is optional, if it's not installed Dash uses the
+# standard plotly encoder.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
@@ -18,3 +30,47 @@ app.server.config.suppress_callback_exceptions = True
 app.config['suppress_callback_exceptions'] = True
 
 server = app.server
+
+
+@server.route(app.config.routes_pathname_prefix + 'shapes/<level>.geojson')
+def shapes_geojson(level):
+    """
+    Serves the geojson of the shapes of a level, the map figures refer to this url (see shapes_geojson_url). The
+    shapes don't change while the app is running, so the browser may cache them.
+    """
+    if level not in ('Buurt', 'Wijk', 'Gemeente'):
+        abort(404)
+    return Response(get_shapes_geojson_string(level), mimetype='application/json',
+                    headers={'Cache-Control': 'public, max-age=86400'})
+
+
+class OrjsonPlotlyJSONEncoder(plotly.utils.PlotlyJSONEncoder):
+    """
+    Encodes the callback responses with orjson. Objects orjson doesn't know, like the Dash components, are still handled
+    by the default method of the plotly encoder. NaN values become null, just like with the plotly encoder.
+    """
+    def encode(self, o):
+        return orjson.dumps(o, default=self.default,
+                            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+
+
+class module_proxy(object):
+    """
+    Forwards every attribute to the wrapped module, except the attributes that are given as overrides.
+    """
+    def __init__(self, module, **overrides):
+        self._module = module
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+
+# Dash encodes the layout and every callback response (including all the stores) with plotly.utils.PlotlyJSONEncoder,
+# which it looks up through the plotly name in the dash.dash module. That name is replaced by a proxy of plotly that
+# only changes PlotlyJSONEncoder, so only the json Dash sends to the browser is written with orjson. Every other
+# plotly lookup of Dash still gets the real module, and plotly itself (and every other user of the encoder) is
+# unchanged.
+if orjson is not None:
+    importlib.import_module('dash.dash').plotly = module_proxy(
+        plotly, utils=module_proxy(plotly.utils, PlotlyJSONEncoder=OrjsonPlotlyJSONEncoder))
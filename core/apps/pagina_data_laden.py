@@ -3,6 +3,7 @@ import numpy as np
 import geopandas as gpd
 import base64
 from datetime import timedelta, datetime
+from threading import Event, Lock
 
 import dash
 import dash_core_components as dcc
@@ -18,7 +19,8 @@ from core.app_multipage import app
 # Import own functions
 from core.utils import upload_button_style, underline_style, get_callback_trigger, tooltip_style
 from core.data_utils import load_meet_je_stad, aggregate_point_data, load_location_data, \
-    read_file, load_dataplatform_data, _get_code, load_gdf_from_json, combine_data_dicts
+    read_file, load_dataplatform_data, _get_code, load_gdf_from_json, load_gdf_from_dataset, combine_data_dicts, \
+    fast_json_loads, get_location_data, gdf_to_store
 
 standard_datasets = ['meet je stad']
 
@@ -138,7 +140,59 @@ def mjs_loader(hidden):
     return loader
 
 
+# Every browser with Meet Je Stad data reloads it with the real time interval. The result of load_mjs is shared between
+# all the users and is only loaded again when it's older than mjs_cache_seconds, so most callbacks don't have to wait
+# for the Meet Je Stad api.
+mjs_cache_seconds = 60 * 5
+mjs_cache = {}
+# The levels that are being loaded right now, with an event that is set when the load is done
+mjs_loading = {}
+mjs_lock = Lock()
+
+
 def load_mjs(shapes, location_code='Buurt', gemeente='Tilburg'):
+    """
+    Returns the Meet Je Stad data of _load_mjs. The data of a level is loaded again when it's older than
+    mjs_cache_seconds, otherwise the cached data is returned. The lock is only held to read and write the cache, the
+    data itself is loaded without it, so a slow Meet Je Stad api doesn't block the other callbacks. The returned
+    dataframe is shared, so it should not be changed.
+    """
+    key = (location_code, gemeente)
+    with mjs_lock:
+        entry = mjs_cache.get(key)
+        if entry is not None and datetime.now() - entry['loaded'] <= timedelta(seconds=mjs_cache_seconds):
+            return entry['result']
+
+        # Only one callback loads a level at a time
+        loading = mjs_loading.get(key)
+        is_loader = loading is None
+        if is_loader:
+            loading = mjs_loading[key] = Event()
+
+    if not is_loader:
+        # Another callback is loading this level already. Return the old data if there is any, otherwise wait for the
+        # other callback. If its load failed, try again.
+        if entry is not None:
+            return entry['result']
+        loading.wait()
+        with mjs_lock:
+            entry = mjs_cache.get(key)
+        if entry is not None:
+            return entry['result']
+        return load_mjs(shapes, location_code=location_code, gemeente=gemeente)
+
+    try:
+        result = _load_mjs(shapes, location_code=location_code, gemeente=gemeente)
+        with mjs_lock:
+            mjs_cache[key] = {'loaded': datetime.now(), 'result': result}
+    finally:
+        with mjs_lock:
+            mjs_loading.pop(key, None)
+        loading.set()
+    return result
+
+
+def _load_mjs(shapes, location_code='Buurt', gemeente='Tilburg'):
     """
     This function loads the Meet Je Stad data. The real MJS loader is in data utils, but this function sets the
     inputs into the correct format and then calls the real loader. Then it processes and aggregates the output to a
@@ -274,7 +328,7 @@ def fill_data_aggregate_dropdown(menuvalue, data):
               [Input('data-aggregate-datasets', 'value'),
                State('data', 'data')])
 def data_aggregate_latlong_warning(dataset_name, data):
-    if data is {} or dataset_name is None:
+    if not data or dataset_name is None:
         return False, False
 
     read_type = data[dataset_name]['read_type']
@@ -283,9 +337,7 @@ def data_aggregate_latlong_warning(dataset_name, data):
 
 
 def aggregate_data(shapes, data, level):
-    dataset = data['data']
-    datadict = json.loads(dataset)
-    data = gpd.GeoDataFrame.from_features(datadict['features']).loc[:, data['columns']]
+    data = load_gdf_from_dataset(data)
     gdf = aggregate_point_data(data, shapes, level=level)  # add location code as column to the dataframe
     return gdf
 
@@ -530,7 +582,7 @@ def set_options(data, datachoice, sep, header):
 
     columns = data['columns']
     data_sep = data['sep']
-    options_df = pd.DataFrame(json.loads(data['dataframe']))
+    options_df = pd.DataFrame(fast_json_loads(data['dataframe']))
     filename = data['filename']
     dataset_name = filename.split('.')[0]
 
@@ -766,19 +818,14 @@ def delete_dataset_are_you_sure(delete_button, no_button, yes_button, is_open):
 
 
 ###################################################### Load data ######################################################
-@app.callback([Output('data', 'data'),
-               Output('shape-data', 'data')],
+@app.callback(Output('data', 'data'),
               # First set all buttons as input. Only if one of those buttons is pressed, the function will be called
-              [Input('mjs-load-button', 'n_clicks'),
-               Input('dataplatform-laden', 'n_clicks'),
+              [Input('dataplatform-laden', 'n_clicks'),
                Input('dataplatform-url', 'n_submit'),
                Input('data-aggregate-button', 'n_clicks'),
                Input('ed-load-button', 'n_clicks'),
                Input('ed-delete-button-yes', 'n_clicks'),
 
-               # MJS
-               Input('mjs-location-type', 'value'),
-
                # Dataplatform API
                State('dataplatform-name', 'value'),
                State('dataplatform-url', 'value'),
@@ -797,20 +844,18 @@ def delete_dataset_are_you_sure(delete_button, no_button, yes_button, is_open):
                State('custom-dataset-kolom', 'value'),
                # Deletingting custom dataset parameters
                State('custom-dataset-delete-name', 'value'),
-               State('data', 'data'),
-               State('shape-data', 'data')])
-def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks, ed_delete,
-              mjs_location_type,
+               State('data', 'data')])
+def load_data(dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks, ed_delete,
               dataplatform_name, dataplatform_url,
               aggregate_name, aggregate_level,
               upload_contents, upload_filename, dataset_name, dataset_read_type, dataset_latitude,
               dataset_longitude, dataset_codecol, dataset_sep, dataset_header,
               delete_name,
-              data, shape_data):
+              data):
     """
     The big data loading function. This function is used to load all the data into the Store. The function is triggered
     if either one of the buttons are pressed.
-    mjs_n_clicks, ed_n_clicks, ed_delete <int>
+    ed_n_clicks, ed_delete <int>
         How many times this button has been clicked. Is more used as a trigger
     upload_contents <byte string>
         This is the content of the uploaded file in encoded bitstrings.
@@ -835,7 +880,7 @@ def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks
     # if data is a string. Assume it is in json format
     if isinstance(data, str):
         try:
-            data = json.loads(data)
+            data = fast_json_loads(data)
         except json.JSONDecodeError as e:
             print(e)
             data = {}
@@ -846,14 +891,6 @@ def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks
     else:
         data = {}
 
-    # If the Meet Je Stad button is clicked, load MJS
-    if mjs_n_clicks > 0 and trigger == 'mjs-load-button':
-        if shape_data is None:
-            shape_data = {}
-        if mjs_location_type not in shape_data.keys():
-            shapes = load_location_data(level=mjs_location_type, gemeente='Tilburg')
-            shape_data[mjs_location_type] = shapes.to_json()
-
     if dp_n_clicks > 0 or url_n_submits > 0 and (trigger == 'dataplatform-laden' or trigger == 'dataplatform-url'):
         if dataplatform_name is None or dataplatform_name == '':
             dataplatform_name = 'Dataset zonder naam'
@@ -864,22 +901,17 @@ def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks
         dp_df = load_dataplatform_data(dataplatform_url)
         read_type = 'latlong' if (dp_df.geom_type == 'Point').all() else 'onbekend'
         dp_columns = list(dp_df.columns)
-        data[dataplatform_name] = {'data': dp_df.to_json(),
+        data[dataplatform_name] = {'data': gdf_to_store(dp_df),
                                    'columns': dp_columns,
                                    'url': dataplatform_url,
                                    'read_type': read_type,
                                    'aggregated': False}
 
     if da_n_clicks > 0 and trigger == 'data-aggregate-button':
-        if shape_data is None:
-            shape_data = {}
-        if aggregate_level in shape_data:
-            shapes = load_gdf_from_json(shape_data[aggregate_level])
-        else:
-            shapes = load_location_data(level=aggregate_level, gemeente='Tilburg')
-            shape_data[aggregate_level] = shapes.to_json()
+        # The data is aggregated with the exact shapes
+        shapes = get_location_data(level=aggregate_level, gemeente='Tilburg')
         aggregated_data = aggregate_data(shapes, data[aggregate_name], aggregate_level)
-        data[aggregate_name]['data'] = aggregated_data.to_json()
+        data[aggregate_name]['data'] = gdf_to_store(aggregated_data)
         data[aggregate_name]['aggregated'] = True
         data[aggregate_name]['columns'] = list(aggregated_data.columns)
 
@@ -907,12 +939,12 @@ def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks
                 data[dataset_name] = {'data': '{}',
                                       'error': 'Er is iets fout gegaan bij het inladen van de dataset. Technische '
                                                f'beschrijving: {e}'}
-            return data, shape_data
+            return data
         ed_columns = list(ed_df.columns)
         # Check if some columns are timestamps. Timestamps are not json serializable, so have to be converted to strings
         ts_bool = ed_df.dtypes.apply(lambda x: x == np.dtype('datetime64[ns]'))
         ed_df.loc[:, ts_bool] = ed_df.loc[:, ts_bool].apply(lambda x: x.dt.strftime('%Y-%m-%d %H:%M:%S'), axis=1)
-        data[dataset_name] = {'data': ed_df.to_json(),
+        data[dataset_name] = {'data': gdf_to_store(ed_df),
                               'read_type': dataset_read_type,
                               'latcol': dataset_latitude,
                               'longcol': dataset_longitude,
@@ -925,7 +957,7 @@ def load_data(mjs_n_clicks, dp_n_clicks, url_n_submits, da_n_clicks, ed_n_clicks
     if ed_delete and trigger == 'ed-delete-button-yes':
         data.pop(delete_name)
 
-    return data, shape_data
+    return data
 
 
 #################################################### Show dataset ####################################################
@@ -946,11 +978,10 @@ def dropdown_options(data, rt_data):
         List with options for the dropdown.
     """
     data = combine_data_dicts(data, rt_data)
-    if data is {}:
+    if not data:
         return [], True
-    keys = list(data.keys())
     # Make all the options for the dropdown with value and label the same value
-    options = [{'label': k, 'value': k} for k in keys]
+    options = [{'label': k, 'value': k} for k in data]
     options.append({'label': 'Laat geen data zien', 'value': 'Leeg'})
     return options, False
 
@@ -987,13 +1018,11 @@ def show_data_in_table(dataset_name, data, rt_data):
         # if nothing is selected show nothing.
         return html.Div(hidden=True)
 
-    if 'error' in list(data[dataset_name].keys()):
+    if 'error' in data[dataset_name]:
         return dbc.Alert([html.P(data[dataset_name]['error'])], color='danger')
 
     # load dataset
-    datadict = json.loads(data[dataset_name]['data'])
-    columns = data[dataset_name]['columns']
-    gdf = gpd.GeoDataFrame.from_features(datadict['features']).loc[:, columns]
+    gdf = load_gdf_from_dataset(data[dataset_name])
 
     # Show dataset
     return dbc.Table.from_dataframe(pd.DataFrame(gdf.drop('geometry', errors='ignore', axis=1)).head(10),
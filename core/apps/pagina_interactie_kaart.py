@@ -1,6 +1,11 @@
-import geopandas as gpd
 import numpy as np
+import pandas as pd
 import json
+import hashlib
+import pickle
+from functools import lru_cache
+from itertools import chain
+from operator import itemgetter
 
 import dash_core_components as dcc
 import dash_html_components as html
@@ -11,8 +16,11 @@ from dash.dependencies import Input, Output, State, ALL
 from core.app_multipage import app
 
 # Import own functions
-from core.data_utils import load_gdf_from_json, load_location_data, combine_data_dicts
-from core.visualisatie_utils import plolty_figure_wrapper, plolty_gemeente_map_wrapper, basic_colors
+from core.data_utils import get_dataset, get_shapes, get_shapes_geojson_string, \
+    get_middle_points, combine_data_dicts
+from core.visualisatie_utils import plolty_figure_wrapper, plolty_gemeente_map_wrapper, basic_colors, map_layout, \
+    add_background, background_figure, figure_to_dict, figure_cache, map_figure_key, group_values, \
+    layers_use_datasets, shapes_geojson_url, hover_label
 from core.utils import get_callback_trigger, tooltip_style
 
 available_colormaps = ['Blues', 'Reds', 'Greens', 'Purples', 'Bluered']
@@ -27,6 +35,9 @@ error_names = {"extra_vis_1" : "Grafiek 1",
                 "extra_vis_2" : "Grafiek 2",
                 "map_vis" : "Kaart visualisatie"}
 
+# Serialized map figures (and their warnings) of earlier callbacks. The key is made with map_figure_key.
+map_figure_cache = figure_cache(size=16)
+
 
 def type_error_numeric(figure_name, inputtype, charttype, name, columnname, types):
     return f"{figure_name}: De {inputtype}-data van de {charttype} '{name}' moet numeriek zijn. De volgende data types komen voor in" \
@@ -41,6 +52,8 @@ layout = html.Div([
         dcc.Store(id='save-layer-warnings-error-store', storage_type='session', data={'warning': [], 'error': []}),
         dcc.Store(id='update-graph-warnings-error-store', storage_type='session', data={'warning': [], 'error': []}),
         dcc.Store(id='update-map-warnings-error-store', storage_type='session', data={'warning': [], 'error': []}),
+        # Hash of the map layers that are currently shown on the map
+        dcc.Store(id='map-layers-hash', storage_type='memory'),
         # On the left we have two visualisations with a dropdown te select which visualization you would like to edit.
         dbc.Col([
             html.Details([
@@ -152,33 +165,6 @@ def _get_level_options(index, value=""):
     return formgroup
 
 
-def _group_values(gdf, groupby_value, group_method, group_to=None):
-    "This functions groups a given geo dataframe with a certain method and then return the dataframe"
-
-    if group_method == 'mean':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).mean().reset_index()
-
-    elif group_method == 'max':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).max().reset_index()
-
-    elif group_method == 'min':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).min().reset_index()
-
-    elif group_method == 'sum':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).sum().reset_index()
-
-    elif group_method == 'frequency':
-        grouped_df = gdf.groupby(groupby_value).count().reset_index()
-
-    else:
-        grouped_df = gdf.groupby(groupby_value).mean().reset_index()
-
-    return grouped_df
-
 ######################################################### General layout functions #########################################################
 def create_formgroup(label_text, component, text_width = 6, choice_width = 6):
     formgroup = dbc.FormGroup(
@@ -203,11 +189,7 @@ def _get_column_options(all_data, chosen_dataset, remove_geometry=True):
     dash dropdown
     """
     columns = all_data[chosen_dataset]['columns']
-    if 'geometry' in columns and remove_geometry:
-        columns.remove('geometry')
-    options = [{'label': c, 'value': c} for c in columns]
-
-    return options
+    return [{'label': c, 'value': c} for c in columns if not (remove_geometry and c == 'geometry')]
 
 
 def _button_layout(show_delete_button, index):
@@ -660,13 +642,13 @@ def _process_choroplethmapbox(figure_wrapper, gdf, layer):
     if regio_name in gdf:
         text = regio_name
         groupby_values = [labels, text]
-        hover_template = "%{text}<br>%{customdata}: %{z}"
+        hover_template = f"%{{text}}<br>{hover_label(layer['map_data'])}: %{{z}}"
     else:
         text = None
         groupby_values = labels
-        hover_template = "%{location}<br>%{customdata}: %{z}"
+        hover_template = f"%{{location}}<br>{hover_label(layer['map_data'])}: %{{z}}"
 
-    grouped_df = _group_values(
+    grouped_df = group_values(
         gdf, groupby_values, layer['aggregate_method'], layer['map_data'])
 
     if layer['aggregate_method'] == 'frequency':
@@ -682,8 +664,7 @@ def _process_choroplethmapbox(figure_wrapper, gdf, layer):
         color_name=color_name,
         color_scale=layer['colormap'],
         hover_template=hover_template,
-        text=grouped_df[text] if text is not None else None,
-        custom_data=[layer['map_data']] * len(grouped_df)
+        text=grouped_df[text] if text is not None else None
     )
 
     return figure_wrapper
@@ -752,13 +733,13 @@ def _process_bubble_mapbox(figure_wrapper, gdf, layer):
     if regio_name in gdf:
         text = regio_name
         groupby_values = [labels, text]
-        hover_template = "%{text}<br>%{customdata}: %{marker.color}"
+        hover_template = f"%{{text}}<br>{hover_label(layer['map_data'])}: %{{marker.color}}"
     else:
         text = None
         groupby_values = labels
-        hover_template = "%{location}<br>%{customdata}: %{marker.color}"
+        hover_template = f"%{{location}}<br>{hover_label(layer['map_data'])}: %{{marker.color}}"
 
-    grouped_df = _group_values(
+    grouped_df = group_values(
         gdf, groupby_values, layer['aggregate_method'], layer['map_data']).sort_values(by=layer['map_data'],
                                                                                        ascending=False)
 
@@ -767,18 +748,20 @@ def _process_bubble_mapbox(figure_wrapper, gdf, layer):
     else:
         color_name = layer['map_data']
 
+    # The map data defines both the color and the size of the bubbles
+    bubble_data = grouped_df[layer['map_data']] if layer['map_data'] else None
+
     figure_wrapper.add_bubble_layer(
         data_key=grouped_df[layer['map_labels']],
-        color=grouped_df[layer['map_data']] if layer['map_data'] is not "" else None,
-        size=grouped_df[layer['map_data']] if layer['map_data'] is not "" else None,
+        color=bubble_data,
+        size=bubble_data,
         show_legend=True,
         name=layer['layer_name'],
         hover_template=hover_template,
         show_scale=True,
         color_name=layer['map_data'],
         text=grouped_df[text] if text is not None else None,
-        color_scale=layer['colormap'],
-        custom_data=[layer['map_data']] * len(grouped_df)
+        color_scale=layer['colormap']
     )
 
     return figure_wrapper
@@ -900,8 +883,8 @@ def save_layer(n_clicks_quit, n_clicks_delete,
             if map_labels[index] is None:
                 raise_data['error'].append(f'{error_names[selected_fig]}: Er is geen regio code (GM/WK/BU) meegegeven.')
 
-        if selected_fig in list(layer_data.keys()):
-            if layer_name_string in list(layer_data[selected_fig].keys()) and add_or_edit != layer_name_string:
+        if selected_fig in layer_data:
+            if layer_name_string in layer_data[selected_fig] and add_or_edit != layer_name_string:
                 raise_data['error'].append(f'{error_names[selected_fig]}: Laag naam ({layer_name_string}) bestaat al voor dit figuur. Kies een '
                                            f'andere naam voor deze visualisatie.')
 
@@ -976,14 +959,20 @@ def update_figures(layer_data, rt_data, all_data):
             figure_outputs.append(no_update)
             continue
 
+        # Only rebuild the figure on a real time update if one of its layers uses real time data
+        if trigger == 'real-time-data' and not layers_use_datasets(layer_data[figure_name], rt_data):
+            figure_outputs.append(no_update)
+            continue
+
         figure_wrapper = plolty_figure_wrapper(
             id=figure_name, title='')
+        figure_layout = dict(margin=dict(l=20, r=20, t=30, b=20))
 
         # if the figure has layers, then we loop over the layers to add them to the visualization
         for key, value in layer_data[figure_name].items():
-            # Load dataset
+            # Load dataset. The geometry column can't be chosen in the graph options, so it is not loaded.
             dataset_name = value['selected_dataset']
-            gdf = load_gdf_from_json(all_data[dataset_name]['data'])
+            gdf = get_dataset(all_data[dataset_name], geometry=False)
 
             if value['visualisation_type'] is None:
                 return no_update
@@ -1029,7 +1018,7 @@ def update_figures(layer_data, rt_data, all_data):
                         y=y,
                         name=value['layer_name'])
                 except ValueError:
-                    typelist = get_unique_types(gdf[value['y_data']].tolist())
+                    typelist = get_unique_types(gdf[value['y_data']])
                     raise_data['error'].append(type_error_numeric(error_names[figure_name], 'y', 'barchart', value['layer_name'],
                                                                   value['y_data'], typelist))
 
@@ -1063,7 +1052,7 @@ def update_figures(layer_data, rt_data, all_data):
                         labels=x.iloc[y_sort],
                         values=y.iloc[y_sort])
                 except ValueError:
-                    typelist = get_unique_types(gdf[value['y_data']].tolist())
+                    typelist = get_unique_types(gdf[value['y_data']])
                     raise_data['error'].append(type_error_numeric(error_names[figure_name], 'waarde', 'piechart', value['layer_name'],
                                                                   value['y_data'], typelist))
 
@@ -1090,21 +1079,16 @@ def update_figures(layer_data, rt_data, all_data):
                     mode=value['mode'])
 
             # Last we update the figures title and axes. The title and axes of the last layer will be used for now.
-
-            figure_wrapper.figure.update_xaxes(
-                title_text=value['x_axis'])
-            figure_wrapper.figure.update_yaxes(
-                title_text=value['y_axis'])
-            figure_wrapper.figure.update_layout(
-                title=value['figure_name']
-            )
-
             # If the figure is a histogram or multi_histogram change the y axis to frequentie
             if value['visualisation_type'] == 'multi_histogram' or value['visualisation_type'] == 'histogram':
-                figure_wrapper.figure.update_yaxes(title_text="frequentie")
+                y_axis = "frequentie"
+            else:
+                y_axis = value['y_axis']
+            figure_layout.update(title=value['figure_name'], xaxis_title_text=value['x_axis'],
+                                 yaxis_title_text=y_axis)
 
-        figure_wrapper.figure.update_layout(
-            margin=dict(l=20, r=20, t=30, b=20))
+        # The layout is updated once, every update of the layout is validated by plotly
+        figure_wrapper.figure.update_layout(**figure_layout)
 
         figure_outputs.append(figure_wrapper.figure)
     print("Update figuur:", raise_data)
@@ -1117,20 +1101,27 @@ def update_figures(layer_data, rt_data, all_data):
 
     return figure_outputs[0], figure_outputs[1], raise_data
 
-def _add_map_layers(figure_wrapper, layer_data, all_data, raise_data):
+def _add_map_layers(figure_wrapper, map_layers, all_data, raise_data):
     # This function adds all given map layers to a map_figure_wrapper
 
     # We loop over all the given layers and add them one by one to the visualization
-    for key, value in layer_data['map_vis'].items():
+    for key, value in map_layers.items():
         # Load dataset
         dataset_name = value['selected_dataset']
-        datadict = json.loads(all_data[dataset_name]['data'])
-        columns = all_data[dataset_name]['columns']
-        gdf = gpd.GeoDataFrame.from_features(
-            datadict['features']).loc[:, columns]
+        # Only the categorical map needs the geometry of the dataset, for the other maps the shapes of the level are used.
+        # The loaded dataset is shared with other layers and callbacks, the filter below makes a copy before it's changed
+        geometry = value['visualisation_type'] == 'categorical_choroplethmapbox'
+        gdf = get_dataset(all_data[dataset_name], geometry=geometry)
 
         # Drop unknown values in the gdf. We do this otherwise the axis are not representative of Tilburg
-        gdf = gdf[gdf[value['map_labels']] != 'onbekend']
+        known_regions = (gdf[value['map_labels']] != 'onbekend').to_numpy()
+        if geometry:
+            gdf = gdf[known_regions]
+        else:
+            # The other maps only use the region code, the region name and the data, so only those columns are copied
+            regio_name = value['map_labels'][:-5] + "_NAAM"
+            used_columns = [c for c in dict.fromkeys([value['map_labels'], regio_name, value['map_data']]) if c in gdf]
+            gdf = gdf.loc[known_regions, used_columns]
 
         # Get level and code signature of that level
         level = value['map_level']
@@ -1166,7 +1157,7 @@ def _add_map_layers(figure_wrapper, layer_data, all_data, raise_data):
                 figure_wrapper = _process_choroplethmapbox(figure_wrapper, gdf, value)
             except ValueError:
                 # If the given data column is not castable to float, raise an error
-                typelist = get_unique_types(gdf[value['map_data']].tolist())
+                typelist = get_unique_types(gdf[value['map_data']])
                 raise_data['error'].append(type_error_numeric(error_names['map_vis'], 'visualisatie', 'Numerieke kaart', value['layer_name'],
                                                               value['map_data'], typelist))
 
@@ -1193,124 +1184,195 @@ def _add_map_layers(figure_wrapper, layer_data, all_data, raise_data):
 
     return figure_wrapper, raise_data
 
+
+def _map_layers_hash(map_layers):
+    """
+    Creates a short hash of the settings of all map layers, to check if the layers on the map have changed.
+    """
+    return hashlib.blake2b(json.dumps(map_layers, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+def _cache_map_figure(key, figure, raise_data):
+    """
+    Serializes the figure once and stores it in the map figure cache. The serialized figure is returned so it can be
+    send to the dashboard directly.
+    """
+    figure_json = figure_to_dict(figure)
+    map_figure_cache.put(key, (figure_json, raise_data))
+    return figure_json
+
+@lru_cache(maxsize=1)
+def _idle_figure():
+    """
+    Creates the map that is shown when there are no layers yet: only the background of gemeente Tilburg on Buurt level.
+    This figure never changes, so it is made and serialized only once.
+    """
+    figure_wrapper = plolty_gemeente_map_wrapper(title='', gdf_gemeente=get_shapes('Buurt'), level='Buurt',
+                                                 json_gemeente=shapes_geojson_url('Buurt'))
+    add_background(figure_wrapper.figure, 'Buurt')
+    figure_wrapper.figure.update_layout(**map_layout)
+    return figure_to_dict(figure_wrapper.figure)
+
+
+def preload_shapes():
+    """
+    Reads the shapes and makes the background of every level. This is called once when the app starts, so the first
+    user that chooses a level doesn't have to wait for the shapefile to be read.
+    """
+    for shapes_level in ['Buurt', 'Wijk', 'Gemeente']:
+        background_figure(shapes_level)
+        get_shapes_geojson_string(shapes_level)
+        get_middle_points(shapes_level)
+    _idle_figure()
+
+
 @app.callback([Output('map-vis', 'figure'),
                Output('map-warning-message', 'children'),
                Output('map-warning-message', 'is_open'),
-               Output('update-map-warnings-error-store', 'data')],
+               Output('update-map-warnings-error-store', 'data'),
+               Output('map-layers-hash', 'data')],
               [Input('layer-data', 'data'),
                Input('real-time-data', 'data'),
                State('data', 'data'),
-               State('shape-data', 'data')])  # , prevent_initial_call=False)
-def update_map(layer_data, rt_data, all_data, shape_data):
+               State('map-layers-hash', 'data')])  # , prevent_initial_call=False)
+def update_map(layer_data, rt_data, all_data, shown_layers_hash):
     """
     This function updates the map figure. It does this whenever another layer is added to layer-data.
     """
     ctx = callback_context
     trigger = get_callback_trigger(ctx)
-    all_data = combine_data_dicts(all_data, rt_data)
 
-    # First check if there are any layers to visualize. If there are None, we create a fake dictionary. This makes it
+    # First check if there are any layers to visualize. If there are None, we use an empty dictionary. This makes it
     # possible to still Show the background even when there is no data yet.
+    map_layers = (layer_data or {}).get('map_vis') or {}
+    layers_hash = _map_layers_hash(map_layers)
+
+    # When the page is loaded without any layers only the background has to be shown, which is always the same figure
+    if trigger == 'No trigger' and not map_layers:
+        return _idle_figure(), no_update, False, no_update, layers_hash
+
+    # layer-data also changes when the other figures are edited. If the map layers are the same as the ones on the map
+    # there is nothing to update.
+    if trigger == 'layer-data' and layers_hash == shown_layers_hash:
+        return no_update
+
     raise_data = {'error': [],
                   'warning': []}
 
-    if layer_data is None:
-        layer_data = {'map_vis': {}}
-    elif 'map_vis' not in layer_data.keys():
-        layer_data['map_vis'] = {}
+    # A real time update only changes the real time datasets. If no map layer uses them the map stays the same, so we
+    # don't have to rebuild and send the whole figure again.
+    if trigger == 'real-time-data' and not layers_use_datasets(map_layers, rt_data):
+        return no_update
 
-    # Check if there are any layers for the map
-    if 'map_vis' in layer_data.keys():
-        map_layers = layer_data['map_vis']
-    else:
-        map_layers = {}
+    all_data = combine_data_dicts(all_data, rt_data)
 
     # Before we loop over the layers we need to find the level. For this we simply take the level of the first added
     # layer
-    if len(list(map_layers)) == 0:
+    if not map_layers:
         chosen_level = 'Buurt'
     else:
-        chosen_level = map_layers[list(map_layers.keys())[0]]['map_level']
+        chosen_level = map_layers[next(iter(map_layers))]['map_level']
 
-    if shape_data is None:
-        shape_data = {}
     # If no level is chosen yet force it to Buurt so there is always a visualization.
     if chosen_level not in ['Buurt', 'Wijk', 'Gemeente']:
         chosen_level = 'Buurt'
 
-    # Check what the chosen level is and find the correct shape data in the shape store. If it doesn't exist yet we
-    # load it in.
-    if chosen_level in shape_data:
-        tilburg_shapes = load_gdf_from_json(shape_data[chosen_level])
-    else:
-        tilburg_shapes = load_location_data(level=chosen_level, gemeente='Tilburg',
-                                            path_to_datasets="datasets/shape_data")
+    # If the exact same map was made before, return the serialized figure instead of building it again
+    figure_key = map_figure_key(map_layers, all_data, chosen_level)
+    cached_figure = map_figure_cache.get(figure_key)
+    if cached_figure is not None:
+        figure_json, cached_raise_data = cached_figure
+        return [figure_json, no_update, False, cached_raise_data, layers_hash]
+
+    # The shapes of every level are only loaded once per process. The map wrapper doesn't change them, so no copy
+    # is needed.
+    tilburg_shapes = get_shapes(chosen_level)
 
     # Create a map figure wrapper and a the background of gemeente Tilburg
     figure_wrapper = plolty_gemeente_map_wrapper(
-        title='', gdf_gemeente=tilburg_shapes, level=chosen_level)
-    figure_wrapper.add_gemeente_background(opacity=0.35)
-    figure_wrapper.add_ringbaan_and_spoor()
-
-    if trigger == 'No trigger' and map_layers == {}:
-        figure_wrapper.figure.update_layout(mapbox=dict(
-            style="open-street-map", zoom=11.5, center={"lat": 51.57, "lon": 5.07}
-        ),
-            legend_orientation='v',
-            legend={'x': 0, 'y': 0},
-            margin=dict(l=0, r=2, t=0, b=0)
-        )
-        return figure_wrapper.figure, no_update, False, no_update
+        title='', gdf_gemeente=tilburg_shapes, level=chosen_level, json_gemeente=shapes_geojson_url(chosen_level),
+        middle_points=get_middle_points(chosen_level))
+    add_background(figure_wrapper.figure, chosen_level)
 
     try:
-        figure_wrapper, raise_data = _add_map_layers(figure_wrapper, layer_data, all_data, raise_data)
+        figure_wrapper, raise_data = _add_map_layers(figure_wrapper, map_layers, all_data, raise_data)
     except AssertionError as e:
         raise_data['error'].append(error_names["map_vis"] + str(e))
 
     # The title of the map figure is defined by the first layer added. But only add if there is atleast one layer
-    if len(layer_data['map_vis'].items()) > 0:
-        first_layer = list(layer_data['map_vis'].keys())[0]
-        figure_wrapper.figure.update_layout(title={'text': layer_data['map_vis'][first_layer]['figure_name'],
-                                                   'x': 0.5,
-                                                   'y': 0.99,
-                                                   'xanchor': 'center',
-                                                   'font': {'size': 28}})
-
-    figure_wrapper.figure.update_layout(mapbox=dict(
-        style="open-street-map", zoom=11.5, center={"lat": 51.57, "lon": 5.07}
-    ),
-        legend_orientation='v',
-        legend={'x': 0, 'y': 0},
-        margin=dict(l=0, r=2, t=0, b=0)
-    )
+    title_layout = {}
+    if map_layers:
+        first_layer = next(iter(map_layers))
+        title_layout['title'] = {'text': map_layers[first_layer]['figure_name'],
+                                 'x': 0.5,
+                                 'y': 0.99,
+                                 'xanchor': 'center',
+                                 'font': {'size': 28}}
+
+    # Update the layout in one go
+    figure_wrapper.figure.update_layout(**map_layout, **title_layout)
 
     if len(raise_data['error']) > 0:
-        return no_update, no_update, False, raise_data
+        return no_update, no_update, False, raise_data, no_update
 
     print('update interactie figure')
-    return [figure_wrapper.figure, no_update, False, raise_data]
+    figure_json = _cache_map_figure(figure_key, figure_wrapper.figure, raise_data)
+    return [figure_json, no_update, False, raise_data, layers_hash]
 
 ######################################################### Update options #########################################################
-@app.callback(
-    # Output extra vis 1
-    [Output('extra-vis-1-options', 'children'),
-     Output('extra-vis-1-options', 'hidden'),
+# Switching between a figure and its options menu only changes the hidden values of the divs, so this is done in the
+# browser. The options menu itself is still made by add_all_divs_to_chosen_figure. The outputs are in the order
+# options hidden, figure hidden for extra vis 1, extra vis 2 and the map, followed by the value of the dropdown.
+app.clientside_callback(
+    """
+    function(chosen_figure, button_delete_clicks, button_quit_clicks, button_back_clicks) {
+        const no_update = window.dash_clientside.no_update;
+        const triggered = window.dash_clientside.callback_context.triggered;
+        if (!triggered || triggered.length === 0) {
+            return no_update;
+        }
+        const trigger = triggered[0].prop_id.split('.')[0];
+        const figures = ['extra_vis_1', 'extra_vis_2', 'map_vis'];
+        const figure_index = figures.indexOf(chosen_figure);
+        if (figure_index === -1) {
+            return no_update;
+        }
+
+        // Show the options menu of the chosen figure and hide the figure itself
+        if (trigger === 'selection-vis-to-change-dropdown') {
+            const outputs = [true, false, true, false, true, false, chosen_figure];
+            outputs[2 * figure_index] = false;
+            outputs[2 * figure_index + 1] = true;
+            return outputs;
+        }
+
+        // Indexing to select the correct button (index 0 for the first and after that always the last in the list)
+        const index = button_quit_clicks.length === 1 ? 0 : button_quit_clicks.length - 1;
+        const buttons = [['button-quit', button_quit_clicks],
+                         ['button-delete', button_delete_clicks],
+                         ['button-go-back', button_back_clicks]];
+
+        // The quit, delete and go back buttons all close the options menu and show the figure again
+        for (const [button_type, button_clicks] of buttons) {
+            if (trigger.includes(button_type) && button_clicks[index] > 0) {
+                const outputs = [no_update, no_update, no_update, no_update, no_update, no_update, ""];
+                outputs[2 * figure_index] = true;
+                outputs[2 * figure_index + 1] = false;
+                return outputs;
+            }
+        }
+        return no_update;
+    }
+    """,
+    [Output('extra-vis-1-options', 'hidden'),
      Output('extra-vis-1-figure-div', 'hidden'),
-
-     # Output extra vis 2
-     Output('extra-vis-2-options', 'children'),
      Output('extra-vis-2-options', 'hidden'),
      Output('extra-vis-2-figure-div', 'hidden'),
-
-     # Output map visualizations
-     Output('map-vis-options', 'children'),
      Output('map-vis-options', 'hidden'),
      Output('map-vis-figure-div', 'hidden'),
 
-     # vReset choose visualization dropdown
-     Output('selection-vis-to-change-dropdown', 'value')
-
-     ],
+     # Reset choose visualization dropdown
+     Output('selection-vis-to-change-dropdown', 'value')],
 
     # Inputs for when to trigger changes
     [Input('selection-vis-to-change-dropdown', 'value'),
@@ -1318,68 +1380,29 @@ def update_map(layer_data, rt_data, all_data, shape_data):
      Input({'type': 'button-quit', 'index': ALL}, 'n_clicks'),
      Input({'type': 'button-go-back', 'index': ALL}, 'n_clicks')]
 )
-def add_all_divs_to_chosen_figure(chosen_figure, button_delete_clicks, button_quit_clicks, button_back_clicks):
+
+
+@app.callback(
+    [Output('extra-vis-1-options', 'children'),
+     Output('extra-vis-2-options', 'children'),
+     Output('map-vis-options', 'children')],
+    [Input('selection-vis-to-change-dropdown', 'value')]
+)
+def add_all_divs_to_chosen_figure(chosen_figure):
     """
-    This callbacks looks at what figure you want to change and then replaces the figure with the option menu. It does
-    this by replace an empty div with the options menu and then switching the hidden values of this div and the figure.
+    This callbacks looks at what figure you want to change and then fills the empty options div of that figure with the
+    option menu. Showing the options menu and hiding the figure is done by the clientside callback above.
     """
-    # Indexing to select the correct button (index 0 for the first and after that always the last in the list)
-    if len(button_quit_clicks) == 1:
-        index = 0
-    else:
-        index = -1
+    # Here we check what figure was chosen. We then fill the options div of the correct figure with block_1.
+    if chosen_figure == 'extra_vis_1':
+        return [general_options_loader(False, True), no_update, no_update]
 
-    ctx = callback_context
-    trigger = ctx.triggered[0]['prop_id'].split('.')[0]
-    # Start block
-    if trigger == 'selection-vis-to-change-dropdown':
-        # Here we check what figure was chosen. We then replace the correct figure with block_1.
-        # The outputs you see here to make the correct components vissible and hidden
-        if chosen_figure == 'extra_vis_1':
-            block_1 = general_options_loader(False, True)
-            return [block_1, False, True, no_update, True, False, no_update, True, False, chosen_figure]
-
-        elif chosen_figure == 'extra_vis_2':
-            block_1 = general_options_loader(False, True)
-            return [no_update, True, False, block_1, False, True, no_update, True, False, chosen_figure]
-
-        elif chosen_figure == 'map_vis':
-            block_1 = general_map_options_loader(False, True)
-            return [no_update, True, False, no_update, True, False, block_1, False, True, chosen_figure]
+    elif chosen_figure == 'extra_vis_2':
+        return [no_update, general_options_loader(False, True), no_update]
+
+    elif chosen_figure == 'map_vis':
+        return [no_update, no_update, general_map_options_loader(False, True)]
 
-        else:
-            return no_update
-
-    # we check for the correct trigger and if it buttons allready exist. If they don't exist they are None.
-    # We also index on the button_clicks because with dynamic indexing it returns a list instead of a single value
-
-    elif 'button-quit' in trigger and button_quit_clicks[index] > 0:
-        if chosen_figure == 'extra_vis_1':
-            return [no_update, True, False, no_update, no_update, no_update, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'extra_vis_2':
-            return [no_update, no_update, no_update, no_update, True, False, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'map_vis':
-            return [no_update, no_update, no_update, no_update, no_update, no_update, no_update, True, False, ""]
-
-    # This needs to be a seperate elif because if the button doesn't exist (when creating a new layer we can't index
-    # on it)
-    elif 'button-delete' in trigger and button_delete_clicks[index] > 0:
-        if chosen_figure == 'extra_vis_1':
-            return [no_update, True, False, no_update, no_update, no_update, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'extra_vis_2':
-            return [no_update, no_update, no_update, no_update, True, False, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'map_vis':
-            return [no_update, no_update, no_update, no_update, no_update, no_update, no_update, True, False, ""]
-
-    elif 'button-go-back' in trigger and button_back_clicks[index] > 0:
-        if chosen_figure == 'extra_vis_1':
-            return [no_update, True, False, no_update, no_update, no_update, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'extra_vis_2':
-            return [no_update, no_update, no_update, no_update, True, False, no_update, no_update, no_update, ""]
-        elif chosen_figure == 'map_vis':
-            return [no_update, no_update, no_update, no_update, no_update, no_update, no_update, True, False, ""]
-
-    # if else then not an intendent trigger
     else:
         return no_update
 
@@ -1395,20 +1418,13 @@ def add_general_options(layer_data, vis_id):
     This callback fills the first dropdown of the options menu. It asks if you want to edit a layer, or change an
     existing layer. If no layers exist, it will only offer to add another layer.
     """
-    # if layer_data is a dict, find the existing layers
-    if isinstance(layer_data, dict):
-        # Check if the key exists
-        if vis_id in layer_data:
-            unique_layers = layer_data[vis_id].keys()
-        else:
-            unique_layers = []
-    else:
-        unique_layers = []
+    # Find the existing layers of the chosen figure, if there are any
+    layer_data = layer_data if isinstance(layer_data, dict) else {}
+    unique_layers = layer_data.get(vis_id) or {}
 
-    add_edit_dropdown_options = [
-        {'label': 'Visualisatie toevoegen', 'value': 'visualisatie toevoegen'}]
-    add_edit_dropdown_options.extend(
-        [{'label': x, 'value': x} for x in unique_layers])
+    # Create the options of the existing layers
+    add_edit_dropdown_options = [{'label': 'Visualisatie toevoegen', 'value': 'visualisatie toevoegen'}]
+    add_edit_dropdown_options += [{'label': layer_name, 'value': layer_name} for layer_name in unique_layers]
 
     return [add_edit_dropdown_options]
 
@@ -1437,12 +1453,13 @@ def add_general_options_part_2(layer_selection, rt_data, chosen_figure, all_data
     will first have to choose the visualization. and what dataset you want to choose. If you want to edit an existing
     layer it wil ... (Functionallity doesn't exist yet)
     """
-    all_data = combine_data_dicts(all_data, rt_data)
     # Check if there is any input
     if layer_selection is None:
         return no_update
 
-    elif layer_selection == 'visualisatie toevoegen':
+    all_data = combine_data_dicts(all_data, rt_data)
+
+    if layer_selection == 'visualisatie toevoegen':
         if isinstance(all_data, dict):
             all_datasets = all_data.keys()
         else:
@@ -1467,6 +1484,77 @@ def add_general_options_part_2(layer_selection, rt_data, chosen_figure, all_data
         return [False, figure_name, options, selected_dataset, selected_visualisation_type]
 
 
+# Gets all the settings of a layer that are used to fill the options menu in one go
+layer_settings_getter = itemgetter('layer_name', 'x_data', 'x_axis', 'y_data', 'y_axis', 'mode', 'map_level', 'map_data',
+                                   'map_labels', 'aggregate_method', 'colormap')
+
+
+def _vis_options_loader(selected_vis, selected_data, columns, layer_values, title_disabled, show_delete_button):
+    """
+    Returns the options of the chosen visualization. The options are cached as pickled bytes, so every caller gets its
+    own copy of the components and changing them doesn't change the cache or the options of other sessions.
+    """
+    return pickle.loads(_vis_options_pickled(selected_vis, selected_data, columns, layer_values, title_disabled,
+                                             show_delete_button))
+
+
+@lru_cache(maxsize=64)
+def _vis_options_pickled(selected_vis, selected_data, columns, layer_values, title_disabled, show_delete_button):
+    """
+    Creates the pickled options of the chosen visualization. The options only depend on the columns of the dataset and
+    the settings of the layer, so they are cached and not recreated every time the same options menu is opened again.
+    Lists in the layer settings are passed as tuples to make them hashable.
+    """
+    all_data = {selected_data: {'columns': list(columns)}}
+    layer_name, x_data, x_axis, y_data, y_axis, mode, map_level, map_data, map_labels, aggregate_method, colormap = \
+        (list(v) if isinstance(v, tuple) else v for v in layer_values)
+
+    if selected_vis == 'scatter':
+        loader = scatter_options_loader(
+            False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, title_disabled,
+            show_delete_button)
+    elif selected_vis == 'barchart':
+        loader = barchart_options_loader(
+            False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, title_disabled,
+            show_delete_button)
+    elif selected_vis == 'grouped_barchart':
+        loader = grouped_barchart_options_loader(
+            False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, mode, title_disabled,
+            show_delete_button)
+    elif selected_vis == 'piechart':
+        loader = piechart_options_loader(
+            False, all_data, selected_data, layer_name, x_data, y_data, title_disabled, show_delete_button)
+    elif selected_vis == 'histogram':
+        loader = histogram_options_loader(
+            False, all_data, selected_data,
+            layer_name, x_data, x_axis, title_disabled,
+            show_delete_button
+        )
+    elif selected_vis == 'multi_histogram':
+        loader = multi_histogram_options_loader(
+            False, all_data, selected_data, layer_name, x_data, mode, title_disabled, show_delete_button)
+
+    # Map options
+    elif selected_vis == 'choroplethmapbox':
+        loader = choroplethmapbox_options_loader(
+            False, all_data, selected_data, 'numerical', layer_name, map_level, map_data, map_labels,
+            aggregate_method, colormap, title_disabled, show_delete_button
+        )
+    elif selected_vis == 'categorical_choroplethmapbox':
+        # Categorical uses the exact same inputs except the type. The inputs only have to be used in a different way
+        loader = choroplethmapbox_options_loader(
+            False, all_data, selected_data, 'categorical', layer_name, map_level, map_data, map_labels,
+            aggregate_method, colormap, title_disabled, show_delete_button)
+    elif selected_vis == 'bubble_mapbox':
+        loader = bubble_choroplethmapbox_options_loader(
+            False, all_data, selected_data, layer_name, map_level, map_data, map_labels,
+            aggregate_method, colormap, title_disabled, show_delete_button)
+    else:
+        loader = no_update
+
+    return pickle.dumps(loader)
+
+
 @app.callback(
     [Output('visualization-options-div', 'hidden'),
      Output('visualization-options-div', 'children')],
@@ -1483,24 +1571,11 @@ def add_vis_specific_options(selected_vis, selected_data, rt_data, all_data, lay
     This callback shows the last part of the options. These are options specific to the chosen visualization.
     So based on what visualization the use chose it will show different layouts.
     """
-    all_data = combine_data_dicts(all_data, rt_data)
-
     # Check if a layer is being edit
     if selected_layer != 'visualisatie toevoegen':
-        # Options for figure visualizations
-        layer_name = layer_data[chosen_figure][selected_layer]['layer_name']
-        x_data = layer_data[chosen_figure][selected_layer]['x_data']
-        x_axis = layer_data[chosen_figure][selected_layer]['x_axis']
-        y_data = layer_data[chosen_figure][selected_layer]['y_data']
-        y_axis = layer_data[chosen_figure][selected_layer]['y_axis']
-        mode = layer_data[chosen_figure][selected_layer]['mode']
-
-        # Options for map visualizations
-        map_level = layer_data[chosen_figure][selected_layer]['map_level']
-        map_data = layer_data[chosen_figure][selected_layer]['map_data']
-        map_labels = layer_data[chosen_figure][selected_layer]['map_labels']
-        aggregate_method = layer_data[chosen_figure][selected_layer]['aggregate_method']
-        colormap = layer_data[chosen_figure][selected_layer]['colormap']
+        # Options for figure visualizations (layer_name up to mode) and map visualizations (map_level up to colormap)
+        layer_name, x_data, x_axis, y_data, y_axis, mode, map_level, map_data, map_labels, aggregate_method, \
+            colormap = layer_settings_getter(layer_data[chosen_figure][selected_layer])
 
         # Options to force edit mode
         title_disabled = True
@@ -1518,53 +1593,35 @@ def add_vis_specific_options(selected_vis, selected_data, rt_data, all_data, lay
             dbc.Alert("Er is nog geen data visualisatie gekozen", color="warning")]
 
     else:
-        if selected_vis == 'scatter':
-            loader = scatter_options_loader(
-                False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, title_disabled,
-                show_delete_button)
-        elif selected_vis == 'barchart':
-            loader = barchart_options_loader(
-                False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, title_disabled,
-                show_delete_button)
-        elif selected_vis == 'grouped_barchart':
-            loader = grouped_barchart_options_loader(
-                False, all_data, selected_data, layer_name, x_data, x_axis, y_data, y_axis, mode, title_disabled,
-                show_delete_button)
-        elif selected_vis == 'piechart':
-            loader = piechart_options_loader(
-                False, all_data, selected_data, layer_name, x_data, y_data, title_disabled, show_delete_button)
-        elif selected_vis == 'histogram':
-            loader = histogram_options_loader(
-                False, all_data, selected_data,
-                layer_name, x_data, x_axis, title_disabled,
-                show_delete_button
-            )
-        elif selected_vis == 'multi_histogram':
-            loader = multi_histogram_options_loader(
-                False, all_data, selected_data, layer_name, x_data, mode, title_disabled, show_delete_button)
-
-        # Map options
-        elif selected_vis == 'choroplethmapbox':
-            loader = choroplethmapbox_options_loader(
-                False, all_data, selected_data, 'numerical', layer_name, map_level, map_data, map_labels,
-                aggregate_method, colormap, title_disabled, show_delete_button
-            )
-        elif selected_vis == 'categorical_choroplethmapbox':
-            # Categorical uses the exact same inputs except the type. The inputs only have to be used in a different way
-            loader = choroplethmapbox_options_loader(
-                False, all_data, selected_data, 'categorical', layer_name, map_level, map_data, map_labels,
-                aggregate_method, colormap, title_disabled, show_delete_button)
-        elif selected_vis == 'bubble_mapbox':
-            loader = bubble_choroplethmapbox_options_loader(
-                False, all_data, selected_data, layer_name, map_level, map_data, map_labels,
-                aggregate_method, colormap, title_disabled, show_delete_button)
-        else:
-            loader = no_update
+        # The data is only needed to find the columns of the chosen dataset
+        all_data = combine_data_dicts(all_data, rt_data)
+        columns = tuple(all_data[selected_data]['columns'])
+        layer_values = tuple(tuple(v) if isinstance(v, list) else v for v in (
+            layer_name, x_data, x_axis, y_data, y_axis, mode, map_level, map_data, map_labels, aggregate_method,
+            colormap))
+        loader = _vis_options_loader(selected_vis, selected_data, columns, layer_values, title_disabled,
+                                     show_delete_button)
 
     return False, loader
 
 
 ############################################ Error and warnings handeling #############################################
+# Styles of the popup. The messages are joined together, only the last message has a bottom border and margin
+popup_header_style = {'border': '1px solid black',
+                      'border-bottom': '0px',
+                      'margin': '3px',
+                      'margin-bottom': '0px'}
+popup_message_style = {'border': '1px solid black',
+                       'border-top': '0px',
+                       'border-bottom': '0px',
+                       'margin': '3px',
+                       'margin-top': '0px',
+                       'margin-bottom': '0px'}
+popup_last_message_style = {**popup_message_style,
+                            'border-bottom': '1px solid black',
+                            'margin-bottom': '3px'}
+
+
 @app.callback([Output('warning-error-popup', 'children'),
                Output('warning-error-popup', 'is_open'),
                Output('open-warnings-error-popup', 'children')],
@@ -1595,8 +1652,9 @@ def raise_and_fill_popup(save_layer_error, update_graph_error, update_map_error,
         return no_update
 
     # combine all errors and warnings
-    errors = {'error': save_layer_error['error'] + update_graph_error['error'] + update_map_error['error'],
-              'warning': save_layer_error['warning'] + update_graph_error['warning'] + update_map_error['warning']}
+    errors = {raise_type: list(chain(save_layer_error[raise_type], update_graph_error[raise_type],
+                                     update_map_error[raise_type]))
+              for raise_type in ['error', 'warning']}
     open_button_text = f"Bekijk foutmeldingen en waarschuwingen ({len(errors['error']) + len(errors['warning'])})"
 
     # if close button is clicked, then close the popup
@@ -1619,55 +1677,55 @@ def raise_and_fill_popup(save_layer_error, update_graph_error, update_map_error,
     for raise_type, alert_type in zip(['error', 'warning'], ['danger', 'warning']):
         if len(errors[raise_type]) > 0:
             # header of popup
+            class_name = f'alert-{alert_type}'
             popup_content.append(dbc.ModalHeader({'error': 'Foutmelding', 'warning': 'Waarschuwing'}[raise_type],
-                                                 className=f'alert-{alert_type}',
-                                                 style={'border': '1px solid black',
-                                                        'border-bottom': '0px',
-                                                        'margin': '3px',
-                                                        'margin-bottom': '0px'}))
+                                                 className=class_name, style=popup_header_style))
             # append all messages to the popup
+            last_message = len(errors[raise_type]) - 1
             for ii, msg in enumerate(errors[raise_type]):
                 # remove bottom border and margin if there are multiple warnings or errors so the messages are all
                 # nicely joined
-                border_bottom = '1px solid black' if ii == len(errors[raise_type]) - 1 else '0px'
-                margin_bottom = '3px' if ii == len(errors[raise_type]) - 1 else '0px'
-                popup_content.append(dbc.ModalBody(msg, className=f'alert-{alert_type}',
-                                                   style={'border': '1px solid black',
-                                                          'border-top': '0px',
-                                                          'border-bottom': border_bottom,
-                                                          'margin': '3px',
-                                                          'margin-top': '0px',
-                                                          'margin-bottom': margin_bottom}))
+                style = popup_last_message_style if ii == last_message else popup_message_style
+                popup_content.append(dbc.ModalBody(msg, className=class_name, style=style))
 
     popup_content.append(old_popup_content[-1])
     return popup_content, pop_modal, open_button_text
 
 
+# typedict is like a translation for technical to non-technical types
+typedict = {
+    int: 'getal',
+    float: 'getal',
+    str: 'tekst/categorisch',
+}
+
+
+def _type_to_string(elem_type):
+    # Translate a type that is not in typedict. If the string representation is in the same format, we can strip down
+    # the representation to get a technical type. If that is not the case, then we say the type is unknown in order
+    # to prevent confusion with the user
+    string_type = str(elem_type)
+    if 'class' in string_type:
+        return string_type.strip('class').strip('<').strip('>').strip("'")
+    return 'onbekend'
+
+
 def get_unique_types(data_list):
-    typedict = {
-        "<class 'int'>": 'getal',
-        "<class 'float'>": 'getal',
-        "<class 'str'>": 'tekst/categorisch',
-    }
+    if isinstance(data_list, pd.Series):
+        # A column with an integer or float dtype only contains numbers, so we don't have to look at every element
+        if not data_list.empty and (pd.api.types.is_integer_dtype(data_list.dtype) or
+                                    pd.api.types.is_float_dtype(data_list.dtype)):
+            return [typedict[float]]
+        data_list = data_list.tolist()
+
     typelist = []
-    for elem in data_list:
-        # Get string representation of type
-        string_type = str(type(elem))
-        try:
-            # typedict is like a translation for technical to non-technical types, but sometimes a different type is
-            # given, which wil yield a KeyError
-            typestr = typedict[string_type]
-        except KeyError:
-            # If the string representation is in the same format, we can strip down the representation to get a
-            # technical type
-            # If that is not the case, then we say the type is unknown in order to prevent confusion with the user
-            if 'class' in string_type:
-                typestr = string_type.strip('class').strip('<').strip('>').strip("'")
-            else:
-                typestr = 'onbekend'
+    # First get the unique types (in order of appearance), so every type only has to be translated once
+    for elem_type in dict.fromkeys(map(type, data_list)):
+        typestr = typedict.get(elem_type)
+        if typestr is None:
+            typestr = _type_to_string(elem_type)
 
         # We want an unique set of types, do not add them if they're already in the list
-        if typestr in typelist:
-            continue
-        typelist.append(typestr)
+        if typestr not in typelist:
+            typelist.append(typestr)
     return typelist
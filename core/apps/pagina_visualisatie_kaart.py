@@ -1,16 +1,16 @@
-import geopandas as gpd
-import json
-
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
+from dash import no_update, callback_context
 from dash.dependencies import Input, Output, State
 
 from core.app_multipage import app
 
 # Import own functions
-from core.data_utils import load_location_data, \
-    load_gdf_from_json, combine_data_dicts
-from core.visualisatie_utils import plolty_gemeente_map_wrapper
+from core.data_utils import get_dataset, get_shapes, get_middle_points, combine_data_dicts
+from core.visualisatie_utils import plolty_gemeente_map_wrapper, map_layout, add_background, figure_to_dict, \
+    figure_cache, map_figure_key, group_values, layers_use_datasets, shapes_geojson_url, \
+    hover_label
+from core.utils import get_callback_trigger
 
 graph_style = {
     'height': '39vh'
@@ -38,32 +38,113 @@ layout = dbc.Col([dcc.Graph(id='kaart', figure={"layout": {"title": '',
     })
 
 
-def _group_values(gdf, groupby_value, group_method, group_to=None):
-    """This functions groups a given geo dataframe with a certain method and then return the dataframe"""
+def _prepare_grouped(gdf, value, hover_value):
+    """
+    Groups the data of a layer per region and creates the texts for the hover. This is the same for the numerical and
+    the bubble maps, only the variable in the hover template (hover_value) is different.
+    """
+    labels = value['map_labels']
+    # With the hover template you can define what text to show on the hover. The variables have to be variables that
+    # are defined in the trace
+    regio_name = value['map_labels'][:-5] + "_NAAM"
+    if regio_name in gdf:
+        text = regio_name
+        groupby_values = [labels, text]
+        hover_template = f"%{{text}}<br>{hover_label(value['map_data'])}: %{{{hover_value}}}"
+    else:
+        text = None
+        groupby_values = labels
+        hover_template = f"%{{location}}<br>{hover_label(value['map_data'])}: %{{{hover_value}}}"
 
-    if group_method == 'mean':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).mean().reset_index()
+    grouped_df = group_values(
+        gdf, groupby_values, value['aggregate_method'], value['map_data'])
 
-    elif group_method == 'max':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).max().reset_index()
+    if value['aggregate_method'] == 'frequency':
+        color_name = 'Aantal'
+    else:
+        color_name = value['map_data']
+
+    return grouped_df, text, hover_template, color_name
+
+
+def _choropleth_layer(figure_wrapper, layer_input, value):
+    grouped_df, text, hover_template, color_name = layer_input
+
+    figure_wrapper.add_level_choroplethmapbox_layer(
+        data=grouped_df[value['map_data']],
+        data_key=grouped_df[value['map_labels']],
+        name=value['layer_name'],
+        show_legend=True,
+        color_name=color_name,
+        color_scale=value['colormap'],
+        hover_template=hover_template,
+        text=grouped_df[text] if text is not None else None
+    )
+
+
+def _categorical_layer(figure_wrapper, layer_input, value):
+    figure_wrapper.add_categorical_level_choroplethmapbox(
+        gdf=layer_input,
+        key_column=value['map_labels'],
+        categorie_column=value['map_data'],
+        legend_group=value['layer_name'],
+        show_legend=True,
+    )
+
+
+def _bubble_layer(figure_wrapper, layer_input, value):
+    grouped_df, text, hover_template, color_name = layer_input
+
+    # The map data defines both the color and the size of the bubbles
+    bubble_data = grouped_df[value['map_data']] if value['map_data'] else None
+
+    figure_wrapper.add_bubble_layer(
+        data_key=grouped_df[value['map_labels']],
+        color=bubble_data,
+        size=bubble_data,
+        show_legend=True,
+        name=value['layer_name'],
+        hover_template=hover_template,
+        show_scale=True,
+        color_name=color_name,
+        text=grouped_df[text] if text is not None else None,
+        color_scale=value['colormap']
+    )
+
+
+# For every visualisation type the function that prepares the data of a layer and the function that adds the layer to
+# the map
+vis_layer_functions = {
+    'choroplethmapbox': (lambda gdf, value: _prepare_grouped(gdf, value, 'z'), _choropleth_layer),
+    'categorical_choroplethmapbox': (lambda gdf, value: gdf, _categorical_layer),
+    'bubble_mapbox': (lambda gdf, value: _prepare_grouped(gdf, value, 'marker.color'), _bubble_layer),
+}
 
-    elif group_method == 'min':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).min().reset_index()
+# Serialized map figures of earlier callbacks. The key is made with map_figure_key.
+map_figure_cache = figure_cache(size=16)
 
-    elif group_method == 'sum':
-        gdf[group_to] = gdf[group_to].astype(float)
-        grouped_df = gdf.groupby(groupby_value).sum().reset_index()
 
-    elif group_method == 'frequency':
-        grouped_df = gdf.groupby(groupby_value).count().reset_index()
+def _compute_layer(value, all_data):
+    """
+    Loads and prepares the data of a layer. This doesn't change the figure.
+    """
+    dataset_name = value['selected_dataset']
+    # Only the categorical map needs the geometry of the dataset, for the other maps the shapes of the level are used.
+    # The loaded dataset is shared with other layers and callbacks, the filter below makes a copy before it's changed
+    geometry = value['visualisation_type'] == 'categorical_choroplethmapbox'
+    gdf = get_dataset(all_data[dataset_name], geometry=geometry)
 
+    # Drop unknown values in the gdf. We do this otherwise the axis are not representative of Tilburg
+    known_regions = (gdf[value['map_labels']] != 'onbekend').to_numpy()
+    if geometry:
+        gdf = gdf[known_regions]
     else:
-        grouped_df = gdf.groupby(groupby_value).mean().reset_index()
+        # The other maps only use the region code, the region name and the data, so only those columns are copied
+        regio_name = value['map_labels'][:-5] + "_NAAM"
+        used_columns = [c for c in dict.fromkeys([value['map_labels'], regio_name, value['map_data']]) if c in gdf]
+        gdf = gdf.loc[known_regions, used_columns]
 
-    return grouped_df
+    return vis_layer_functions[value['visualisation_type']][0](gdf, value)
 
 
 # map callback
@@ -72,159 +153,71 @@ def _group_values(gdf, groupby_value, group_method, group_to=None):
     [Input(component_id='url', component_property='pathname'),
      Input('real-time-data', 'data'),
      State('layer-data', 'data'),
-     State('data', 'data'),
-     State('shape-data', 'data')]
+     State('data', 'data')]
 )
-def update_graph(url, rt_data, layer_data, all_data, shape_data):
-    # First check if there are any layers to visualize. If there are None, we create a fake dictionary. This makes it
+def update_graph(url, rt_data, layer_data, all_data):
+    ctx = callback_context
+    trigger = get_callback_trigger(ctx)
+
+    # The map is only shown on the map page, on other pages there is nothing to update
+    if url != '/apps/BMB_visualisatie_kaart':
+        return [no_update]
+
+    # First check if there are any layers to visualize. If there are None, we use an empty dictionary. This makes it
     # possible to still Show the background even when there is no data yet.
-    if isinstance(layer_data, dict):
-        if 'map_vis' not in layer_data.keys():
-            layer_data['map_vis'] = {}
-    else:
-        layer_data = {'map_vis': {}}
+    map_layers = (layer_data or {}).get('map_vis') or {}
 
-    all_data = combine_data_dicts(all_data, rt_data)
+    # A real time update only changes the real time datasets. If no map layer uses them the map stays the same.
+    if trigger == 'real-time-data' and not layers_use_datasets(map_layers, rt_data):
+        return [no_update]
 
-    # Check if there are any layers for the map
-    if 'map_vis' in layer_data.keys():
-        map_layers = layer_data['map_vis']
-    else:
-        map_layers = {}
+    all_data = combine_data_dicts(all_data, rt_data)
 
     # Before we loop over the layers we need to find the level. For this we simply take the level of the first added
     # layer
-    if len(list(map_layers)) == 0:
+    if not map_layers:
         chosen_level = 'Buurt'
     else:
-        chosen_level = map_layers[list(map_layers.keys())[0]]['map_level']
+        chosen_level = map_layers[next(iter(map_layers))]['map_level']
 
-    if shape_data is None:
-        shape_data = {}
     # If no level is chosen yet force it to Buurt so there is always a visualization.
     if chosen_level not in ['Buurt', 'Wijk', 'Gemeente']:
         chosen_level = 'Buurt'
 
-    # Check what the chosen level is and find the correct shape data in the shape store. If it doesn't exist yet we
-    # load it in.
-    if chosen_level in shape_data:
-        tilburg_shapes = load_gdf_from_json(shape_data[chosen_level])
-    else:
-        tilburg_shapes = load_location_data(level=chosen_level, gemeente='Tilburg',
-                                            path_to_datasets="datasets/shape_data")
+    # If the exact same map was made before (for example when the page is opened again), return the serialized figure
+    # instead of building it again
+    figure_key = map_figure_key(map_layers, all_data, chosen_level)
+    figure_json = map_figure_cache.get(figure_key)
+    if figure_json is not None:
+        return [figure_json]
+
+    # The shapes of every level are only loaded once per process. The map wrapper doesn't change them, so no copy
+    # is needed.
+    tilburg_shapes = get_shapes(chosen_level)
 
     # Create a map figure wrapper and a the background of gemeente Tilburg
-    figure_wrapper = plolty_gemeente_map_wrapper(title='', gdf_gemeente=tilburg_shapes, level=chosen_level)
-    figure_wrapper.add_gemeente_background(opacity=0.35)
-    figure_wrapper.add_ringbaan_and_spoor()
-
-    # if the figure has layers, then we loop over the layers to add them to the visualization
-    for key, value in layer_data['map_vis'].items():
-        # Load dataset
-        dataset_name = value['selected_dataset']
-        datadict = json.loads(all_data[dataset_name]['data'])
-        columns = all_data[dataset_name]['columns']
-        gdf = gpd.GeoDataFrame.from_features(
-            datadict['features']).loc[:, columns]
-
-        # Drop unknown values in the gdf. We do this otherwise the axis are not representative of Tilburg
-        gdf = gdf[gdf[value['map_labels']] != 'onbekend']
-
-        if value['visualisation_type'] is None:
-            continue
-
-        # Return the correct visualization based on the layer options
-        elif value['visualisation_type'] == 'choroplethmapbox':
-            labels = value['map_labels']
-            regio_name = value['map_labels'][:-5] + "_NAAM"
-            if regio_name in gdf:
-                text = regio_name
-                groupby_values = [labels, text]
-                hover_template = "%{text}<br>%{customdata}: %{z}"
-            else:
-                text = None
-                groupby_values = labels
-                hover_template = "%{location}<br>%{customdata}: %{z}"
-
-            grouped_df = _group_values(
-                gdf, groupby_values, value['aggregate_method'], value['map_data'])
-
-            if value['aggregate_method'] == 'frequency':
-                color_name = 'Aantal'
-            else:
-                color_name = value['map_data']
-
-            figure_wrapper.add_level_choroplethmapbox_layer(
-                data=grouped_df[value['map_data']],
-                data_key=grouped_df[labels],
-                name=value['layer_name'],
-                show_legend=True,
-                color_name=color_name,
-                color_scale=value['colormap'],
-                hover_template=hover_template,
-                text=grouped_df[text] if text is not None else None,
-                custom_data=[value['map_data']] * len(grouped_df)
-            )
-
-        elif value['visualisation_type'] == 'categorical_choroplethmapbox':
-            figure_wrapper.add_categorical_level_choroplethmapbox(
-                gdf=gdf,
-                key_column=value['map_labels'],
-                categorie_column=value['map_data'],
-                legend_group=value['layer_name'],
-                show_legend=True,
-            )
-
-        elif value['visualisation_type'] == 'bubble_mapbox':
-            # In this function we make the neccesary steps to process the dashboard data to create a bubble mapbox layer
-            labels = value['map_labels']
-            # With the hover template you can define what text to show on the hover. The variables have to be
-            # variables that are defined in a go.Scattermapbox
-            regio_name = value['map_labels'][:-5] + "_NAAM"
-            if regio_name in gdf:
-                text = regio_name
-                groupby_values = [labels, text]
-                hover_template = "%{text}<br>%{customdata}: %{marker.color}"
-            else:
-                text = None
-                groupby_values = labels
-                hover_template = "%{location}<br>%{customdata}: %{marker.color}"
-
-            grouped_df = _group_values(
-                gdf, groupby_values, value['aggregate_method'], value['map_data'])
-
-            if value['aggregate_method'] == 'frequency':
-                color_name = 'Aantal'
-            else:
-                color_name = value['map_data']
-
-            figure_wrapper.add_bubble_layer(
-                data_key=grouped_df[value['map_labels']],
-                color=grouped_df[value['map_data']] if value['map_data'] is not "" else None,
-                size=grouped_df[value['map_data']] if value['map_data'] is not "" else None,
-                show_legend=True,
-                name=value['layer_name'],
-                hover_template=hover_template,
-                show_scale=True,
-                color_name=color_name,
-                text=grouped_df[text] if text is not None else None,
-                color_scale=value['colormap'],
-                custom_data=[value['map_data']] * len(grouped_df)
-            )
-
-    figure_wrapper.figure.update_layout(mapbox_style="open-street-map",
-                                        mapbox_zoom=11.5, mapbox_center={"lat": 51.57, "lon": 5.07},
-                                        legend_orientation='v',
-                                        legend={'x': 0, 'y': 0},
-                                        margin=dict(l=0, r=2, t=0, b=0),
-                                        )
+    figure_wrapper = plolty_gemeente_map_wrapper(title='', gdf_gemeente=tilburg_shapes, level=chosen_level,
+                                                 json_gemeente=shapes_geojson_url(chosen_level),
+                                                 middle_points=get_middle_points(chosen_level))
+    add_background(figure_wrapper.figure, chosen_level)
+
+    # if the figure has layers, then we add them to the visualization in the order of the layers
+    for value in map_layers.values():
+        if value['visualisation_type'] in vis_layer_functions:
+            # Add the correct visualization based on the layer options
+            vis_layer_functions[value['visualisation_type']][1](figure_wrapper, _compute_layer(value, all_data), value)
+
+    figure_wrapper.figure.update_layout(**map_layout)
 
     # The title of the map figure is defined by the last layer added. But only add if there is atleast one layer
-    if len(layer_data['map_vis'].items()) > 0:
-        first_layer = list(layer_data['map_vis'].keys())[0]
-        figure_wrapper.figure.update_layout(title={'text': layer_data['map_vis'][first_layer]['figure_name'],
+    if map_layers:
+        first_layer = next(iter(map_layers))
+        figure_wrapper.figure.update_layout(title={'text': map_layers[first_layer]['figure_name'],
                                                    'x': 0.5,
                                                    'y': 0.99,
                                                    'xanchor': 'center',
                                                    'font': {'size': 28}})
-    return [figure_wrapper.figure]
+
+    figure_json = figure_to_dict(figure_wrapper.figure)
+    map_figure_cache.put(figure_key, figure_json)
+    return [figure_json]
@@ -2,6 +2,8 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np
 from netCDF4 import Dataset
+from shapely.geometry import shape, mapping
+from shapely import wkt
 
 import datetime as dt
 
@@ -10,15 +12,49 @@ from requests.exceptions import HTTPError
 from dateutil import tz
 import json
 import io
+import base64
+import zlib
 import os
 
-from collections import Counter
-
 import warnings
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson parses large (geo)json strings a lot faster than the standard json library. It is optional, if it's not
+# installed we fall back on json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# pyarrow is needed to read the shapes from parquet files, which is faster than reading the shape files. It is
+# optional, if it's not installed the shape files are read.
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
 
+# Long periods of meet je stad data are requested in parts at the same time, the waiting time of the requests then
+# overlaps instead of adding up
+mjs_max_requests = 8
+mjs_min_request_minutes = 60
+mjs_executor = ThreadPoolExecutor(max_workers=mjs_max_requests)
+
+
+def _request_meet_je_stad(start_utc, end_utc):
+    """
+    Requests the meet je stad data between two utc dates and returns the list of measurements
+    """
+    start_str = start_utc.strftime("%Y-%m-%d,%H:%M")
+    end_str = end_utc.strftime("%Y-%m-%d,%H:%M")
+
+    with urlopen(f"https://meetjestad.net/data/?type=sensors&format=json&start={start_str}&end={end_str}") as url:
+        return fast_json_loads(url.read())
+
+
 def load_meet_je_stad(start: dt.datetime, end: dt.datetime,
                       timezone=tz.gettz('W. Europe Standard Time'),
                       output_filename: str = None,
@@ -88,22 +124,33 @@ def load_meet_je_stad(start: dt.datetime, end: dt.datetime,
 
     assert start < end, 'Start timestamp must be earlier than end timestamp'
 
-    start_str = start.astimezone(dt.timezone.utc).strftime("%Y-%m-%d,%H:%M")
-    end_str = end.astimezone(dt.timezone.utc).strftime("%Y-%m-%d,%H:%M")
-
-    with urlopen(f"https://meetjestad.net/data/?type=sensors&format=json&start={start_str}&end={end_str}") as url:
-        data = json.loads(url.read().decode())
-        assert len(data) > 0, f'No data found for start date ({start}) and end date ({end})'
-
-    df = pd.json_normalize(data)
-    df.timestamp = pd.to_datetime(df.timestamp, format='%Y-%m-%d %H:%M:%S', utc=True).dt.tz_convert('Europe/Amsterdam')
-    df.timestamp = df.timestamp.apply(lambda x: x.tz_localize(None))
+    # The api works with whole minutes, split the period in at most mjs_max_requests parts of at least
+    # mjs_min_request_minutes and request all the parts at the same time
+    start_utc = start.astimezone(dt.timezone.utc).replace(second=0, microsecond=0)
+    end_utc = end.astimezone(dt.timezone.utc).replace(second=0, microsecond=0)
+    minutes = int((end_utc - start_utc).total_seconds() // 60)
+    n_requests = max(1, min(mjs_max_requests, minutes // mjs_min_request_minutes))
+    borders = [start_utc + dt.timedelta(minutes=minutes * i // n_requests) for i in range(n_requests + 1)]
+
+    data = []
+    for part in mjs_executor.map(_request_meet_je_stad, borders[:-1], borders[1:]):
+        data.extend(part)
+    assert len(data) > 0, f'No data found for start date ({start}) and end date ({end})'
+
+    # The measurements are flat records (extra is a list, not a nested object), so no normalisation is needed
+    df = pd.DataFrame.from_records(data)
+    if n_requests > 1:
+        # Measurements exactly on the border of two parts are returned by both requests
+        df = df.drop_duplicates(subset='row')
+    df.timestamp = pd.to_datetime(df.timestamp, format='%Y-%m-%d %H:%M:%S', utc=True,
+                                  cache=True).dt.tz_convert('Europe/Amsterdam').dt.tz_localize(None)
     df = df.set_index('row')
 
-    geom = gpd.points_from_xy(df['longitude'], df['latitude'])
+    geom = gpd.points_from_xy(df['longitude'].to_numpy(dtype=np.float64, copy=False),
+                              df['latitude'].to_numpy(dtype=np.float64, copy=False))
     gdf = gpd.GeoDataFrame(df, geometry=geom, crs=4326)
 
-    if type(output_filename) == str:
+    if isinstance(output_filename, str):
         gdf.to_csv(output_filename, sep=';')
     elif output_filename is not None:
         warnings.warn('Output_filename is given, but was not a string. Convert filename to string if the dataframe '
@@ -115,6 +162,10 @@ def load_meet_je_stad(start: dt.datetime, end: dt.datetime,
     return gdf
 
 
+# Number of decimals of the coordinates of the simplified shapes
+shape_precision = 5
+
+
 def load_location_data(level="Buurt", gemeente='Tilburg', path_to_datasets="datasets/shape_data"):
     """
     This function loads the shape data of a chosen Gemeente. In this github repo we have the shape file of the
@@ -175,6 +226,16 @@ def load_location_data(level="Buurt", gemeente='Tilburg', path_to_datasets="data
         8791  180330.367156  POLYGON ((5.08145 51.55484, 5.08202 51.55473, ...
         8792  100710.950514  POLYGON ((5.09799 51.55989, 5.09796 51.55987, ...
     """
+    # The cached dataframe is shared between calls, so every caller gets its own copy
+    return _load_location_data_cached(level, gemeente, path_to_datasets).copy()
+
+
+@lru_cache(maxsize=16)
+def _load_location_data_cached(level, gemeente, path_to_datasets):
+    """
+    Reads and projects the shape file of load_location_data once per (level, gemeente, path_to_datasets). The
+    returned geopandas dataframe is shared, so it should not be changed.
+    """
     if level == 'Buurt':
         shape_file = os.path.join(THIS_FOLDER, path_to_datasets, "buurt_2020_v1.shp")
     elif level == 'Wijk':
@@ -186,36 +247,103 @@ def load_location_data(level="Buurt", gemeente='Tilburg', path_to_datasets="data
         print("level has to be Buurt, Wijk or Gemeente. None of these were chosen so Buurt wil be loaded")
         shape_file = os.path.join(THIS_FOLDER, path_to_datasets, "buurt_2020_v1.shp")
 
-    # Read shape file as geopanda dataframe
-    df = gpd.read_file(shape_file)
+    code = _get_code(level)
+    name = code[:-5] + "_NAAM"
+
+    # Read the parquet version of the shape file if it's made with convert_shapes_to_parquet, otherwise read the shape
+    # file as geopanda dataframe
+    parquet_file = shape_file[:-len('.shp')] + '.parquet'
+    if pyarrow is not None and os.path.exists(parquet_file):
+        df = gpd.read_parquet(parquet_file, columns=list(dict.fromkeys([code, name, 'GM_NAAM', 'geometry'])))
+    elif gemeente != 'All' and level != 'Gemeente':
+        # Only the shapes within the bounding box of the gemeente have to be parsed, geopandas converts the bounding
+        # box to the crs of the shape file
+        gemeente_shape = _load_location_data_cached('Gemeente', gemeente, path_to_datasets)
+        df = gpd.read_file(shape_file, bbox=gemeente_shape if len(gemeente_shape) > 0 else None)
+    else:
+        df = gpd.read_file(shape_file)
 
     # Select the corresponding gemeente
     if gemeente != 'All':
         df = df[df['GM_NAAM'] == gemeente]
 
-    # Make sure the shape files are in the correct CRS format
-    df = df.to_crs("EPSG:4326")
-    # Drop everything except the BU/WK/GM code and the shapes
-    code = _get_code(level)
-    name = code[:-5] + "_NAAM"
-    df = df[[code, name, 'geometry']]
+    # Make sure the shape files are in the correct CRS format, a file that already is in EPSG:4326 is not projected
+    if df.crs is None or df.crs.to_epsg() != 4326:
+        df = df.to_crs("EPSG:4326")
+    # Drop everything except the BU/WK/GM code and the shapes. The shapes are kept exact, they are used to find the
+    # region of points and a simplified border could put a point in the wrong region.
+    df = gpd.GeoDataFrame(df[[code, name]], geometry=df.geometry, crs=df.crs)
 
     return df
 
 
-def _add_level_column(row, shapes, code):
+def _simplify_shapes(geometry, tolerance):
     """
-    Function for the apply of aggregate point data
+    Simplifies a geoseries of shapes with the given tolerance and rounds the coordinates to shape_precision decimals.
+    Every shape is simplified on its own, so the borders of neighbouring shapes no longer match exactly. Only use this
+    for shapes that are shown, not for shapes that are used to find the region of points.
     """
-    punt = row['geometry']
-    selectie = shapes['geometry'].contains(punt)
-    name = code[:-5] + "_NAAM"
-    code = shapes.loc[selectie, [code, name]]
+    geometry = geometry.simplify(tolerance=tolerance, preserve_topology=True)
+    return geometry.apply(lambda geom: wkt.loads(wkt.dumps(geom, rounding_precision=shape_precision)))
 
-    if len(code.values) == 0:
-        return ['onbekend', 'onbekend']
-    else:
-        return [code.values[0][0], code.values[0][1]]
+
+def convert_shapes_to_parquet(path_to_datasets="datasets/shape_data"):
+    """
+    Saves the columns of the Buurt, Wijk and Gemeente shape files that load_location_data uses as parquet files next
+    to the shape files. When the parquet files exist (and pyarrow is installed) load_location_data reads those instead
+    of the shape files, which is a lot faster. The shapes are already projected to EPSG:4326 in the parquet files, so
+    that isn't repeated on every start of the app. Run this again when the shape files are replaced.
+    """
+    for level, file_name in [('Buurt', "buurt_2020_v1"), ('Wijk', "wijk_2020_v1"), ('Gemeente', "gemeente_2020_v1")]:
+        code = _get_code(level)
+        name = code[:-5] + "_NAAM"
+        columns = list(dict.fromkeys([code, name, 'GM_NAAM', 'geometry']))
+        df = gpd.read_file(os.path.join(THIS_FOLDER, path_to_datasets, file_name + ".shp"))[columns].to_crs("EPSG:4326")
+        df.to_parquet(os.path.join(THIS_FOLDER, path_to_datasets, file_name + ".parquet"))
+
+
+# Tolerance (in degrees) used to simplify the shapes of every level for the maps. At the zoom level of the maps the
+# removed points are smaller than a pixel, so the maps look the same but contain a lot less points.
+shape_simplify_tolerance = {'Buurt': 0.0001, 'Wijk': 0.0002, 'Gemeente': 0.0005}
+
+
+def get_location_data(level="Buurt", gemeente='Tilburg'):
+    """
+    Returns the cached shape data of a level without the copy of load_location_data. Every call returns the same
+    geopandas dataframe, so callers should make a copy if they want to change it.
+    """
+    return _load_location_data_cached(level, gemeente, "datasets/shape_data")
+
+
+@lru_cache(maxsize=4)
+def get_shapes(level="Buurt", gemeente='Tilburg'):
+    """
+    Loads the shape data of a level once per process. Every next call returns the same geopandas dataframe, so callers
+    should make a copy if they want to change it. The shapes are simplified, so they should only be used for maps.
+    """
+    shapes = get_location_data(level=level, gemeente=gemeente).copy()
+    shapes['geometry'] = _simplify_shapes(shapes.geometry, shape_simplify_tolerance.get(level, 0.0001))
+    return shapes
+
+
+@lru_cache(maxsize=4)
+def get_shapes_geojson_string(level="Buurt", gemeente='Tilburg'):
+    """
+    Converts the shapes of a level to a geojson string once per process. This is the geojson the map figures use, it
+    is served to the browser by the /shapes route of the app. The maps only link the shapes on their code, so the other
+    columns are left out of the geojson.
+    """
+    shapes = get_shapes(level=level, gemeente=gemeente)
+    return gdf_to_json(shapes[[_get_code(level), shapes.geometry.name]])
+
+
+@lru_cache(maxsize=4)
+def get_middle_points(level="Buurt", gemeente='Tilburg'):
+    """
+    Calculates the middle points of the shapes of a level (see _middle_points) once per process. The returned
+    dataframe is shared, so it should not be changed.
+    """
+    return _middle_points(level, get_shapes(level=level, gemeente=gemeente))
 
 
 def aggregate_point_data(df, shapes, level='Buurt', gemeente="Tilburg", lat_name='latitude', lon_name='longitude'):
@@ -280,18 +408,25 @@ def aggregate_point_data(df, shapes, level='Buurt', gemeente="Tilburg", lat_name
     """
     code = _get_code(level)
     # If a normal dataframe is passed transform it to a geo dataframe
-    if type(df) == pd.DataFrame:
-        geo_df = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[lon_name], df[lat_name]))
-    else:
+    if isinstance(df, gpd.GeoDataFrame):
         geo_df = df
-    # First set all values of code to 'onbekend' (unknown) later we fill all the values that we can find with the
-    # Corresponding code
-    code_column = geo_df.apply(lambda x: _add_level_column(x, shapes, code), axis=1)
+    else:
+        geom = gpd.points_from_xy(df[lon_name].to_numpy(dtype=np.float64, copy=False),
+                                  df[lat_name].to_numpy(dtype=np.float64, copy=False))
+        geo_df = gpd.GeoDataFrame(df, geometry=geom, crs=4326)
     name = code[:-5] + "_NAAM"
-    temp_df = pd.DataFrame(code_column.to_list(), columns=[code, name])
-    # df = pd.DataFrame(code_column, columns = [code, name])
-    geo_df[code] = temp_df[code]
-    geo_df[name] = temp_df[name]
+    # Join the points on the shapes in one go, the spatial index of sjoin only tests the shapes whose bounding box
+    # contains the point. The points get a positional index so the result can be written back regardless of the index
+    # of geo_df
+    points = gpd.GeoDataFrame(geometry=geo_df.geometry.values, crs=geo_df.crs or shapes.crs)
+    if shapes.crs is not None and points.crs != shapes.crs:
+        points = points.to_crs(shapes.crs)
+    joined = gpd.sjoin(points, shapes[[code, name, 'geometry']], how='left', op='within')
+    # A point on the border of two shapes is matched twice, keep the first match like the old loop did
+    joined = joined[~joined.index.duplicated(keep='first')].sort_index()
+    # Points that are not located in any of the shapes get the value 'onbekend' (unknown)
+    geo_df[code] = joined[code].fillna('onbekend').values
+    geo_df[name] = joined[name].fillna('onbekend').values
     return geo_df
 
 
@@ -455,12 +590,15 @@ def read_file(filename: str, header: int = 1, latitude_col: str = 'latitude', lo
             if sep is None:
                 sep = _get_sep(decode.split('\n'), is_file=False)
 
+        # A file on disk is memory mapped, so the C parser reads it without copying it into a buffer first
+        memory_map = isinstance(contents, str)
         # Try reading in the data with normal utf-8 encoding. If that doesnt work, try ISO.
         try:
-            df = pd.read_table(contents, sep=sep, low_memory=False, header=header - 1, nrows=nrows)
+            df = pd.read_table(contents, sep=sep, low_memory=False, header=header - 1, nrows=nrows,
+                               memory_map=memory_map)
         except UnicodeError:
             df = pd.read_table(contents, encoding="ISO-8859-1", sep=sep, low_memory=False, header=header - 1,
-                               nrows=nrows)
+                               nrows=nrows, memory_map=memory_map)
     else:
         raise IOError('File extension not recognised. Must be one of [xlsx, csv, txt]')
 
@@ -474,7 +612,8 @@ def read_file(filename: str, header: int = 1, latitude_col: str = 'latitude', lo
             raise ValueError('Latitude or longitude column names are not in table headers')
         try:
             # Convert latitude and longitude floats to points
-            geom = gpd.points_from_xy(df[longitude_col], df[latitude_col])
+            geom = gpd.points_from_xy(df[longitude_col].to_numpy(dtype=np.float64, copy=False),
+                                      df[latitude_col].to_numpy(dtype=np.float64, copy=False))
         except ValueError as e:
             raise ValueError('Getting points from the given longitude and latitude columns failed')
     elif read_type == 'geometry':
@@ -483,9 +622,11 @@ def read_file(filename: str, header: int = 1, latitude_col: str = 'latitude', lo
         # Use geometry_col as geometry
         geom = geometry_col
     else:
-        shapes = load_location_data(level=read_type, path_to_datasets=path_to_shapes)
+        # The shapes only contain the code, name and geometry columns and are not changed by the merge, so the cached
+        # shapes are used without making a copy first
+        shapes = _load_location_data_cached(read_type, 'Tilburg', path_to_shapes)
         shape_code = {'Buurt': 'BU_CODE', 'Wijk': 'WK_CODE', 'Gemeente': 'GM_CODE'}[read_type]
-        df = df.merge(shapes, left_on=codecol, right_on=shape_code)
+        df = df.merge(shapes, left_on=codecol, right_on=shape_code, copy=False)
         if len(df) == 0:
             raise ValueError('Result dataframe is empty after merging location shape data and given dataset')
         geom = 'geometry'
@@ -504,20 +645,24 @@ def _convert_excel_decimals(df, latcol, longcol, latbase=51, longbase=3):
     # coordinates of The Netherlands is roughly between 51 and 54. This indicates that the coordinate should be
     # 51.63576559424015 which is the original devided by 10^14. On the other hand, if this was not the latitude, but the
     # given longitude instead, it should be devided by 10^15 because the longitude coordinates should be between 3 and 8
+    # The conversion works on whole numpy arrays, so every column is converted at once instead of value by value
     convert_lat_long = lambda x, coord_base: x / (10 ** (np.floor(np.log10(x // coord_base))))
 
-    if (df[latcol] < 51).all() | (df[latcol] > 54).all():
-        converted_lat = df[latcol].apply(lambda x: convert_lat_long(x, coord_base=latbase))
-        if (converted_lat < 51).all() | (converted_lat > 54).all():
+    lat = df[latcol].to_numpy(dtype=np.float64)
+    # All values are below or above the range when the maximum is below or the minimum is above it
+    if lat.size and (lat.max() < 51 or lat.min() > 54):
+        converted_lat = convert_lat_long(lat, coord_base=latbase)
+        if converted_lat.max() < 51 or converted_lat.min() > 54:
             warnings.warn('Latitude coordinates deviates from expected values and can not be succesfully scaled. Be '
                           'cautious in using these coordinates')
         else:
             warnings.warn('Latitude coordinates deviates from expected values. The values will be scaled.')
             df[latcol] = converted_lat
 
-    if (df[longcol] < 3).all() | (df[longcol] > 8).all():
-        converted_long = df[longcol].apply(lambda x: convert_lat_long(x, coord_base=longbase))
-        if (converted_long < 3).all() | (converted_long > 8).all():
+    long = df[longcol].to_numpy(dtype=np.float64)
+    if long.size and (long.max() < 3 or long.min() > 8):
+        converted_long = convert_lat_long(long, coord_base=longbase)
+        if converted_long.max() < 3 or converted_long.min() > 8:
             warnings.warn('Longitude coordinates deviates from expected values and can not be succesfully scaled. Be '
                           'cautious in using these coordinates')
         else:
@@ -565,10 +710,25 @@ def convert_data_types(df, dtypedict):
     boomhoogte         object
     dtype: object
     """
+    valid_dtypes = {}
     for column in dtypedict.keys():
         if column not in df.columns:
             warnings.warn(f'({column}) not in DataFrame columns. Ignoring datatype conversion')
             continue
+        valid_dtypes[column] = dtypedict[column]
+    if not valid_dtypes:
+        return df
+
+    # Convert all the columns in one astype call, only if one of the conversions fails every column is converted on its
+    # own so the failing columns can be ignored
+    try:
+        columns = list(valid_dtypes.keys())
+        df[columns] = df[columns].astype(valid_dtypes)
+        return df
+    except (TypeError, ValueError):
+        pass
+
+    for column in valid_dtypes.keys():
         try:
             try:
                 df[column] = df[column].astype(dtypedict[column])
@@ -582,31 +742,25 @@ def convert_data_types(df, dtypedict):
     return df
 
 
+# The characters that are recognised as separator of a csv or txt file
+sep_candidates = (',', ';', '\t', '|')
+
+
 def _get_sep(file, is_file=True):
     # Get first and second line from file
     if is_file:
         with open(file, r'r') as enc:
-            lines = enc.readlines()
+            first = enc.readline()
+            second = enc.readline()
     else:
-        lines = file
-
-    first = lines[0]
-    second = lines[1]
+        first = file[0]
+        second = file[1]
 
-    # Get character frequency and sort by most common
-    counter_first = Counter(first).most_common()
-
-    # Get character frequency and do not sort since this converts it into a tuple
-    counter_second = Counter(second)
-
-    for c, freq in counter_first:
-        # Check if character is a letter, a digit or a new line character
-        if c.isalpha() or c.isdigit() or c == '\n':
-            continue
-
-        # if there are as many characters in the first line as in the second line, this could mean this is the seperator
-        if counter_second[c] == freq:
-            return c
+    # A candidate that occurs as many times in the first line as in the second line could be the separator, if more
+    # candidates do, the most common one is chosen
+    counts = [(first.count(c), c) for c in sep_candidates if first.count(c) > 0 and first.count(c) == second.count(c)]
+    if counts:
+        return max(counts)[1]
 
     warnings.warn('No separator found. Using tab as separator')
     return '\t'
@@ -648,30 +802,132 @@ def _get_code(level):
     return code
 
 
-def _find_middle_point(code, level, shapes):
+def _middle_points(level, shapes):
     """
-    Function that finds the coordinates of the middle point of a shape
+    Function that finds the coordinates of the middle points of all the shapes at once. Returns a dataframe with the
+    columns lon and lat and the code of the shape as index.
     """
     level_code = _get_code(level)
-    if code == 'onbekend':
-        return [None, None]
-    else:
-        geometry = shapes[shapes[level_code] == code]['geometry'].values[0]
-        middle_point = geometry.centroid
-        lon = middle_point.x
-        lat = middle_point.y
-        return [lon, lat]
+    middle_points = shapes['geometry'].centroid
+    middle_points = pd.DataFrame({'lon': middle_points.x.values, 'lat': middle_points.y.values},
+                                 index=shapes[level_code].values)
+    return middle_points[~middle_points.index.duplicated()]
+
+
+def fast_json_loads(jsonstr):
+    """
+    Parses a json string with orjson if it's installed and with the standard json library otherwise
+    """
+    if orjson is not None:
+        return orjson.loads(jsonstr)
+    return json.loads(jsonstr)
+
+
+def _features_to_gdf(features, crs=None):
+    """
+    Creates a geopandas dataframe from a list of GeoJSON features. The properties are read column wise and all the
+    geometries are converted in one pass. This is faster than GeoDataFrame.from_features, which builds a dictionary for
+    every single feature before creating the dataframe.
+    """
+    properties = pd.DataFrame.from_records([feature['properties'] or {} for feature in features])
+    geometry = [shape(feature['geometry']) if feature['geometry'] else None for feature in features]
+    return gpd.GeoDataFrame(properties, geometry=geometry, crs=crs)
+
+
+def gdf_to_json(gdf):
+    """
+    Writes a geopandas dataframe as GeoJSON string, in the same format as GeoDataFrame.to_json. With orjson the
+    properties are collected column wise and the whole collection is written in one call, which is a lot faster.
+    """
+    if orjson is None:
+        return gdf.to_json()
+
+    properties = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).to_dict('records')
+    features = [{'id': str(index), 'type': 'Feature', 'properties': feature_properties,
+                 'geometry': mapping(geometry) if geometry is not None else None}
+                for index, feature_properties, geometry in zip(gdf.index, properties, gdf.geometry)]
+    return orjson.dumps({'type': 'FeatureCollection', 'features': features},
+                        option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+
+
+# Prefix of the json strings in the stores that are compressed with pack_json
+packed_json_prefix = 'zlib:'
+
+
+def pack_json(jsonstr):
+    """
+    Compresses a json string for the dcc.Store components. The stores are sent to the server as State with every
+    callback that uses them (uncompressed) and the session storage of the browser is limited to about 5MB, GeoJSON
+    compresses to a fraction of its size. zlib is used instead of gzip, because gzip writes the time in its header and
+    the same json has to give the same string.
+    """
+    return packed_json_prefix + base64.b64encode(zlib.compress(jsonstr.encode())).decode('ascii')
+
+
+def unpack_json(jsonstr):
+    """
+    Returns the json string of a string made by pack_json. Other strings (json that is not compressed) are returned as
+    is.
+    """
+    if jsonstr.startswith(packed_json_prefix):
+        return zlib.decompress(base64.b64decode(jsonstr[len(packed_json_prefix):])).decode()
+    return jsonstr
+
+
+def gdf_to_store(gdf):
+    """
+    Writes a geopandas dataframe as compressed GeoJSON string for the data store
+    """
+    return pack_json(gdf_to_json(gdf))
 
 
 def load_gdf_from_json(jsonstr):
     """
-    Loads geopandas dataframe from json-string
+    Loads geopandas dataframe from json-string (compressed with pack_json or not)
+    """
+    return _features_to_gdf(fast_json_loads(unpack_json(jsonstr))['features'], crs=4326)
+
+
+def load_gdf_from_dataset(dataset):
+    """
+    Loads the geopandas dataframe of a dataset from the data store. Only the columns of the dataset are returned.
+    """
+    return _features_to_gdf(fast_json_loads(unpack_json(dataset['data']))['features']).loc[:, dataset['columns']]
+
+
+def load_df_from_dataset(dataset):
     """
-    return gpd.GeoDataFrame.from_features(json.loads(jsonstr)['features'], crs=4326)
+    Loads the columns of a dataset from the data store as a pandas dataframe, without the geometry. Converting the
+    geometries is the slowest part of loading a dataset, so use this function when the geometry is not needed.
+    """
+    columns = [column for column in dataset['columns'] if column != 'geometry']
+    features = fast_json_loads(unpack_json(dataset['data']))['features']
+    return pd.DataFrame.from_records([feature['properties'] or {} for feature in features], columns=columns)
+
+
+@lru_cache(maxsize=16)
+def _load_cached_dataset(data, columns, geometry):
+    dataset = {'data': data, 'columns': list(columns)}
+    if geometry:
+        return load_gdf_from_dataset(dataset)
+    return load_df_from_dataset(dataset)
+
+
+def get_dataset(dataset, geometry=True):
+    """
+    Loads a dataset from the data store, with load_gdf_from_dataset or without the geometry with load_df_from_dataset.
+    The dataframe is cached on the contents of the dataset, so callbacks and layers that use the same data only parse
+    it once. Every next call returns the same dataframe, so callers should make a copy if they want to change it.
+    """
+    return _load_cached_dataset(dataset['data'], tuple(dataset['columns']), geometry)
 
 
 def combine_data_dicts(data1, data2):
-    for key in data2.keys():
-        data1[key] = data2[key]
+    """
+    Adds the datasets of data2 to data1. Most of the time there is no real time data, then data1 is returned as is.
+    """
+    if not data2:
+        return data1
 
+    data1.update(data2)
     return data1
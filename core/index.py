@@ -3,6 +3,7 @@ import dash_core_components as dcc
 import dash_html_components as html
 import sys
 import os
+import logging
 
 sys.path.insert(0, os.getcwd())
 
@@ -10,7 +11,7 @@ sys.path.insert(0, os.getcwd())
 from core import app
 # Connect to your app pages
 from core import dl, vk, ik
-from core.data_utils import load_location_data, load_gdf_from_json
+from core.data_utils import get_location_data, gdf_to_store
 from core.utils import get_callback_trigger
 from core.apps.pagina_data_laden import load_mjs
 
@@ -18,7 +19,7 @@ import dash
 from dash import no_update
 from dash.dependencies import Input, Output, State
 
-import base64
+log = logging.getLogger(__name__)
 
 # Set Standard variables
 button_style = {'width': '10%',
@@ -32,144 +33,169 @@ list_style = {'list-style-type': 'none',
               'margin-top': '2px',
               'margin-bottom': '2px'}
 
-
-THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
-logo_path = os.path.join(THIS_FOLDER, '..', 'afbeeldingen', "181205-bibliotheek-plectrum-only.png")
-encoded_logo = base64.b64encode(open(logo_path, 'rb').read()).decode('ascii')
+logo_style = {'width': '2%',
+              'margin-right': '1%',
+              'margin-top': '0.3%',
+              'float': 'left'}
+
+top_bar_style = {'vertical-align': 'top',
+                 'display': 'inline-block',
+                 'width': '100%'}
+
+# The meet je stad data is reloaded every real_time_interval ms. When the data didn't change since the last reload the
+# interval is doubled, up to real_time_max_interval, and it's reset as soon as the data changes again.
+real_time_interval = 1000 * 60 * 15
+real_time_max_interval = 1000 * 60 * 60
+
+# The logo is served from the assets folder, so the browser caches it instead of receiving it inlined in every layout
+logo_src = app.get_asset_url("181205-bibliotheek-plectrum-only.png")
+
+# The top bar and footer are the same on every page
+top_bar = html.Ul([
+    html.Li(
+        html.A(html.Div(
+            html.Img(src=logo_src, style=logo_style),
+            id='logo'), href='/'), style=list_style),
+    html.Li(dcc.Link(html.Button('Datasets', id='Datasets_knop',
+                                 style=button_style),
+                     href='/apps/BMB_datasets'),
+            style=list_style),
+    html.Li(dcc.Link(html.Button('Data-interactie', id='Interactie_kaart_knop',
+                                 style=button_style),
+                     href='/apps/BMB_interactie_kaart'),
+            style=list_style),
+    html.Li(dcc.Link(html.Button('Datavisualisatie', id='Visualisatie_kaart_knop',
+                                 style=button_style),
+                     href='/apps/BMB_visualisatie_kaart'),
+            style=list_style)
+], id='top_bar', className='row', style=top_bar_style)
+
+footer = html.Footer(['© Gemaakt door Tau Omega in samenwerking met Bibliotheek Midden-Brabant. ',
+                     html.A('Github.', href='https://github.com/')], style={'display': 'flex'},
+                     id='footer')
 
 app.layout = html.Div([
     html.Title('Monitor van de Stad'),
     dcc.Location(id='url', refresh=False),
-    dcc.Store(id='shape-data', storage_type='session'),
     dcc.Store(id='layer-data', storage_type='session'),
     dcc.Store(id='dataset-counter', storage_type='session', data=0),
     dcc.Loading(dcc.Store(id='data', storage_type='session', data={}), fullscreen=True, color='#ff7320',
                 style={'opacity': '0.2'}),
     dcc.Store(id='real-time-data', storage_type='session', data={}),
     dcc.Interval(id='real-time-trigger',
-                 interval=1000 * 60 * 15,
+                 interval=real_time_interval,
                  n_intervals=0,
                  disabled=True),
-    html.Ul([
-        html.Li(
-            html.A(html.Div(
-                html.Img(src='data:image/png;base64,{}'.format(encoded_logo),
-                         style={'width': '2%',
-                                'margin-right': '1%',
-                                'margin-top': '0.3%',
-                                'float': 'left'}),
-                id='logo'), href='/'), style=list_style),
-        html.Li(dcc.Link(html.Button('Datasets', id='Datasets_knop',
-                                     style=button_style),
-                         href='/apps/BMB_datasets'),
-                style=list_style),
-        html.Li(dcc.Link(html.Button('Data-interactie', id='Interactie_kaart_knop',
-                                     style=button_style),
-                         href='/apps/BMB_interactie_kaart'),
-                style=list_style),
-        html.Li(dcc.Link(html.Button('Datavisualisatie', id='Visualisatie_kaart_knop',
-                                     style=button_style),
-                         href='/apps/BMB_visualisatie_kaart'),
-                style=list_style)
-    ], id='top_bar', className='row', style={'vertical-align': 'top', 'display': 'inline-block', 'width': '100%'}),
+    top_bar,
     html.Br(),
     html.Div(id='page-content'),
-    html.Footer(['© Gemaakt door Tau Omega in samenwerking met Bibliotheek Midden-Brabant. ',
-                html.A('Github.', href='https://github.com/')], style={'display': 'flex'},
-                id='footer')
-
+    footer
 ], id='main-div')
 
 
-@app.callback([Output('page-content', 'children'),
-               Output('top_bar', 'hidden'),
-               Output('footer', 'hidden')],
+# The page layouts are built once, on every change of url the callback only has to look up the layout of the page. The
+# datasets page stays in the layout of the other pages (hidden) so its components keep their state.
+datasets_page = [html.Div(dl.layout, hidden=False)]
+hidden_datasets_page = [html.Div(dl.layout, hidden=True)]
+page_layouts = {'/': datasets_page,
+                '/apps/BMB_datasets': datasets_page,
+                '/apps/BMB_interactie_kaart': hidden_datasets_page + [ik.layout],
+                '/apps/BMB_visualisatie_kaart': hidden_datasets_page + [vk.layout]}
+
+
+@app.callback(Output('page-content', 'children'),
               [Input('url', 'pathname')])
 def display_page(pathname):
-    hide_datasets = pathname != '/apps/BMB_datasets' and pathname != '/'
-    layout = [html.Div(dl.layout, hidden=hide_datasets)]
-    if pathname == '/apps/BMB_interactie_kaart':
-        layout.append(ik.layout)
-        return layout, False, False
-    if pathname == '/apps/BMB_visualisatie_kaart':
-        layout.append(vk.layout)
-        return layout, True, True
-
-    return layout, False, False
-
-
-@app.callback(Output('main-div', 'style'),
-              Input('url', 'pathname'))
-def reset_style(pathname):
-    if pathname == '/apps/BMB_visualisatie_kaart':
-        return {'margin-top': '-24px',
-                'width': '100'}
-    else:
-        return {
-            'margin-left': '2%',
-            'margin-right': '2%'
+    return page_layouts.get(pathname, hidden_datasets_page)
+
+
+# The style of the page and whether the top bar and footer are shown only depend on the url, so the browser sets them
+# without a request to the server. The visualisation map is shown full screen.
+app.clientside_callback(
+    """
+    function(pathname) {
+        if (pathname === '/apps/BMB_visualisatie_kaart') {
+            return [{'margin-top': '-24px', 'width': '100'}, true, true];
         }
+        return [{'margin-left': '2%', 'margin-right': '2%'}, false, false];
+    }
+    """,
+    [Output('main-div', 'style'),
+     Output('top_bar', 'hidden'),
+     Output('footer', 'hidden')],
+    [Input('url', 'pathname')])
 
 
 ###################################################### Real Time ######################################################
+def _mjs_record(mjs_json, mjs_df, start, end, mjs_location_type):
+    """
+    Creates the entry of the Meet Je Stad data in the real-time-data store. The dates are written with isoformat, which
+    gives the same 'YYYY-MM-DD HH:MM:SS' string as strftime without parsing a format string.
+    """
+    return {'data': mjs_json,
+            'date_1': start.isoformat(sep=' ', timespec='seconds'),
+            'date_2': end.isoformat(sep=' ', timespec='seconds'),
+            'columns': list(mjs_df.columns),
+            'region_type': mjs_location_type}
+
+
 @app.callback([Output('real-time-data', 'data'),
-               Output('real-time-trigger', 'disabled')],
+               Output('real-time-trigger', 'disabled'),
+               Output('real-time-trigger', 'interval')],
               [Input('real-time-trigger', 'n_intervals'),
                Input('mjs-load-button', 'n_clicks'),
-               Input('mjs-location-type', 'value'),
-
                Input('ed-delete-button-yes', 'n_clicks'),
+
+               State('mjs-location-type', 'value'),
                State('custom-dataset-delete-name', 'value'),
 
-               State('shape-data', 'data'),
-               State('real-time-data', 'data')])
-def load_real_time_data(n_intervals, mjs_n_clicks, mjs_location_type,
-                        delete_clicks, delete_dataset_name,
-                        shape_data, data):
+               State('real-time-data', 'data'),
+               State('real-time-trigger', 'interval')],
+              prevent_initial_call=True)
+def load_real_time_data(n_intervals, mjs_n_clicks, delete_clicks,
+                        mjs_location_type, delete_dataset_name,
+                        data, interval):
+    # The exact shapes of get_location_data are used to find the region of the points
     ctx = dash.callback_context
     trigger = get_callback_trigger(ctx)
 
     if delete_clicks and trigger == 'ed-delete-button-yes':
         data.pop(delete_dataset_name)
-        return data, True
+        return data, True, no_update
 
     if mjs_n_clicks > 0 and trigger == 'mjs-load-button':
-        if shape_data is None:
-            shape_data = {}
-        if mjs_location_type in shape_data:
-            shapes = load_gdf_from_json(shape_data[mjs_location_type])
-        else:
-            shapes = load_location_data(level=mjs_location_type, gemeente='Tilburg')
+        shapes = get_location_data(level=mjs_location_type, gemeente='Tilburg')
         mjs_df, start, end = load_mjs(shapes, mjs_location_type)
-        mjs_columns = list(mjs_df.columns)
-        data['meet je stad'] = {'data': mjs_df.to_json(),
-                                'date_1': start.strftime('%Y-%m-%d %H:%M:%S'),
-                                'date_2': end.strftime('%Y-%m-%d %H:%M:%S'),
-                                'columns': mjs_columns,
-                                'region_type': mjs_location_type}
-        return data, False
+        data['meet je stad'] = _mjs_record(gdf_to_store(mjs_df), mjs_df, start, end, mjs_location_type)
+        return data, False, real_time_interval
 
     # If interval triggered or mjs button is clicked, load MJS
     if n_intervals > 0 and trigger == 'real-time-trigger':
         if len(data) == 0:
             return no_update
         mjs_location_type = data['meet je stad']['region_type']
-        shapes = load_gdf_from_json(shape_data[mjs_location_type])
+        shapes = get_location_data(level=mjs_location_type, gemeente='Tilburg')
 
-        print(f'MJS loaded\nInterval: {n_intervals}')
         mjs_df, start, end = load_mjs(shapes, mjs_location_type)
-        mjs_columns = list(mjs_df.columns)
-        data['meet je stad'] = {'data': mjs_df.to_json(),
-                                'date_1': start.strftime('%Y-%m-%d %H:%M:%S'),
-                                'date_2': end.strftime('%Y-%m-%d %H:%M:%S'),
-                                'columns': mjs_columns,
-                                'region_type': mjs_location_type}
-        print(f"Time: {end.strftime('%H:%M:%S')}\n")
+        mjs_json = gdf_to_store(mjs_df)
+        log.info('MJS loaded, interval: %d, time: %s', n_intervals, end)
+
+        # If no sensor sent a new measurement the store is not sent back to the browser, so none of the maps that use
+        # it are made again. The next reload waits twice as long.
+        if mjs_json == data['meet je stad']['data']:
+            return no_update, no_update, min(2 * (interval or real_time_interval), real_time_max_interval)
+
+        data['meet je stad'] = _mjs_record(mjs_json, mjs_df, start, end, mjs_location_type)
 
-        return data, False
+        # The interval is already running, so only the interval has to be reset if it was increased
+        return data, no_update, no_update if interval == real_time_interval else real_time_interval
 
     return no_update
 
 
 if __name__ == '__main__':
+    # The callbacks log with the logging module, the messages are only formatted if their level is shown
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    # Read the shapes of the maps once when the app starts, instead of in the callback of the first user
+    ik.preload_shapes()
     app.run_server(debug=False)
@@ -40,7 +40,6 @@ def underline_style(text: str, id: str):
 
 def get_callback_trigger(ctx):
     if not ctx.triggered:
-        button_id = 'No trigger'
-    else:
-        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    return button_id
+        return 'No trigger'
+    # The prop_id is '<component id>.<property>', partition doesn't build a list of all the parts like split does
+    return ctx.triggered[0]['prop_id'].partition('.')[0]
@@ -1,16 +1,42 @@
 import plotly.graph_objects as go
 import plotly.express as px
+import plotly.io as pio
+import plotly.utils
 import pandas as pd
 import numpy as np
 import os
-
-from core.data_utils import _get_code, _find_middle_point
-
 import json
+import html
+from collections import OrderedDict
+from threading import Lock
+from types import MappingProxyType
+from functools import lru_cache
+
+from core.app_multipage import app
+from core.data_utils import _get_code, _middle_points, fast_json_loads, gdf_to_json, get_shapes
+
+# orjson writes the figures a lot faster than plotly, which converts every array to a list first. It is optional, if
+# it's not installed we fall back on plotly.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 basic_colors = px.colors.qualitative.Alphabet
+
+# The layout of every map of gemeente Tilburg. With a constant uirevision the browser keeps the zoom and position of
+# the map and only redraws what changed, instead of resetting the whole map on every update. The layout is shared by
+# all callbacks, so it is read only.
+map_layout = MappingProxyType(dict(mapbox=dict(style="open-street-map", zoom=11.5, center={"lat": 51.57, "lon": 5.07}),
+                                   legend={'orientation': 'v', 'x': 0, 'y': 0},
+                                   margin=dict(l=0, r=2, t=0, b=0),
+                                   uirevision='map-vis'))
+
 THIS_FOLDER = os.path.dirname(os.path.abspath(__file__))
 
+# The number of points from which a scatter is drawn with WebGL instead of svg
+webgl_threshold = 5000
+
 
 class plolty_figure_wrapper(object):
     """
@@ -67,7 +93,11 @@ class plolty_figure_wrapper(object):
             The name of this specific visualization that is added to the figure. This is different from the title.
             If multipile visualizations are added than this name will be the one shown in the legenda. Default: None
         """
-        data = go.Scatter(x=x, y=y, mode=mode, name=name)
+        # Large scatters are drawn with WebGL, the svg renderer of plotly becomes very slow with many points
+        if len(x) > webgl_threshold:
+            data = go.Scattergl(x=x, y=y, mode=mode, name=name)
+        else:
+            data = go.Scatter(x=x, y=y, mode=mode, name=name)
         self.figure.add_trace(data)
 
     def create_barchart(self, x, y, name=None):
@@ -108,11 +138,8 @@ class plolty_figure_wrapper(object):
             to compare multipile groups and 'stack' is used to add them together and compare them as a whole'.
             Default: 'group'
         """
-        group_names = data_dict.keys()
-        for group in group_names:
-            group_dict = data_dict[group]
-            self.figure.add_trace(
-                go.Bar(name=group, x=group_dict['x'], y=group_dict['y']))
+        self.figure.add_traces([go.Bar(name=group, x=group_dict['x'], y=group_dict['y'])
+                                for group, group_dict in data_dict.items()])
 
         self.figure.update_layout(barmode=mode)
 
@@ -149,7 +176,7 @@ class plolty_figure_wrapper(object):
         """
         data = go.Histogram(x=x, name=name)
         self.figure.add_trace(data)
-        self.figure.update_yaxes(title_text='frequentie')
+        self.figure.update_layout(yaxis_title_text='frequentie')
 
     def create_multi_histogram(self, data_dict, mode='overlay'):
         """
@@ -170,14 +197,10 @@ class plolty_figure_wrapper(object):
             to compare multipile groups and 'stack' is used to add them together and visualize them as a whole'.
             Default: 'overlay'
         """
-        groups = data_dict.keys()
-        for group in groups:
-            group_dict = data_dict[group]
-            self.figure.add_trace(go.Histogram(x=group_dict['x'], name=group))
+        self.figure.add_traces([go.Histogram(x=group_dict['x'], name=group, opacity=0.75)
+                                for group, group_dict in data_dict.items()])
 
-        self.figure.update_layout(barmode=mode)
-        self.figure.update_traces(opacity=0.75)
-        self.figure.update_yaxes(title_text='frequentie')
+        self.figure.update_layout(barmode=mode, yaxis_title_text='frequentie')
 
 
 class plolty_gemeente_map_wrapper(object):
@@ -200,6 +223,14 @@ class plolty_gemeente_map_wrapper(object):
     gdf_gemeente <geo.dataframe>
         a geo dataframe that contains the geometry of the chosen level.
 
+    json_gemeente <dict or str>
+        optional, the geojson of gdf_gemeente or the url of it (see shapes_geojson_url). If it's not given it is
+        created from gdf_gemeente.
+
+    middle_points <pandas dataframe>
+        optional, the middle points of the shapes in gdf_gemeente (see get_middle_points). If it's not given it is
+        calculated from gdf_gemeente when the first bubble layer is added.
+
     Example:
         ------
     >>> level = 'Wijk'
@@ -218,23 +249,27 @@ class plolty_gemeente_map_wrapper(object):
     def __init__(self,
                  title: str,
                  level: str,
-                 gdf_gemeente):
+                 gdf_gemeente,
+                 json_gemeente=None,
+                 middle_points=None):
         self.title = title
         self.level = level
         self.gdf_gemeente = gdf_gemeente
         self.figure = go.Figure()
         self.scale_count = 0
         self.category_count = 0
+        # If the middle points of the shapes aren't given, they are only calculated when a bubble layer is added
+        self.middle_points = middle_points
 
         # Add WK/BU/GM code
         self.code = _get_code(self.level)
 
-        # Create geojson for visualizations
-        string_shapes_json = self.gdf_gemeente.to_json()
-        self.json_gemeente = json.loads(string_shapes_json)
-
-        # Add value to gdf for background visualizations
-        self.gdf_gemeente['background'] = 0
+        # Create geojson for visualizations, unless it is already given. Only the code is needed to link the data to
+        # the shapes.
+        if json_gemeente is None:
+            string_shapes_json = gdf_to_json(self.gdf_gemeente[[self.code, self.gdf_gemeente.geometry.name]])
+            json_gemeente = fast_json_loads(string_shapes_json)
+        self.json_gemeente = json_gemeente
 
     def show(self, mapbox_style="carto-positron", token=None):
         """
@@ -256,11 +291,10 @@ class plolty_gemeente_map_wrapper(object):
         self.figure = go.Figure()
 
     def check_length(self, obj1, obj2):
-        if len(obj1) == len(obj2):
-            return None
-        else:
+        # Only the lengths are written in the error, writing the whole inputs can make a very large message
+        if len(obj1) != len(obj2):
             raise ValueError(
-                "Two inputs are not of the same length. This error arises because of: {} and {}".format(obj1, obj2))
+                "Two inputs are not of the same length. The lengths are: {} and {}".format(len(obj1), len(obj2)))
 
     def add_gemeente_background(self, show_legend=False, opacity=0.2):
         """
@@ -276,15 +310,13 @@ class plolty_gemeente_map_wrapper(object):
         opacity <float>
             opacity has to be between 0 and 1. The opacity defines how see through the background shapes are. Default: 0.2
         """
-        # This is the standard location for the BU/WK/GM code
-        id_str_name = 'properties.' + self.code
-
-        map_vis_background = go.Choroplethmapbox(geojson=self.json_gemeente, locations=self.gdf_gemeente[self.code],
-                                                 z=self.gdf_gemeente.background,
-                                                 featureidkey=id_str_name, marker_opacity=opacity, showscale=False,
-                                                 hoverinfo='skip',
-                                                 name='background shapes', legendgroup='background shapes',
-                                                 showlegend=show_legend)
+        # The shapes are drawn by mapbox as layers below the traces, instead of as a choropleth trace with the same
+        # value for every shape. The colors are the ones the choropleth had.
+        background_layers = [dict(sourcetype='geojson', source=self.json_gemeente, type='fill', color='#cb4778',
+                                  opacity=opacity, below='traces'),
+                             dict(sourcetype='geojson', source=self.json_gemeente, type='line', color='#444444',
+                                  line=dict(width=1), opacity=opacity, below='traces')]
+        self.figure.update_layout(mapbox_layers=list(self.figure.layout.mapbox.layers) + background_layers)
 
         icons = go.Scattermapbox(
             lat=[51.560403],
@@ -299,44 +331,34 @@ class plolty_gemeente_map_wrapper(object):
             marker=dict(size=5)
         )
 
-        self.figure.add_trace(map_vis_background)
+        # A layer has no legend item, so an empty trace is added to the legend instead
+        if show_legend:
+            self.figure.add_trace(go.Scattermapbox(lat=[None], lon=[None], mode='markers',
+                                                   marker=dict(size=10, color='#cb4778'), hoverinfo='skip',
+                                                   name='background shapes', legendgroup='background shapes'))
         # self.figure.add_trace(icons)
 
     def add_ringbaan_and_spoor(self, show_legend=True):
         """
         This function adds the ring roads and trainrails of Tilburg to the map
         """
-        filename = os.path.join(THIS_FOLDER, 'datasets', 'Wegen_spoor_Tilburg.json')
-        with open(filename, 'r') as f:
-            roads = json.load(f)
-
-        ringbaan_data = []
-        spoor_data = []
-        for key, values in roads.items():
-            if values['Type'] == 'Ringbaan':
-                for color, width in zip(['#444444', "#FCD6A4"], [4, 2]):
-                    ringbaan_data.append(go.Scattermapbox(
-                        lat=values['Latitude'],
-                        lon=values['Longitude'],
-                        mode="lines",
-                        line=dict(width=width, color=color),
-                        showlegend=(len(ringbaan_data) == 1) and show_legend,
-                        legendgroup='ringbaan',
-                        name='Ringbaan',
-                        text=key))
-            elif values['Type'] == 'Spoor':
-                for color, width in zip(['#555555', '#777777'], [4, 2]):
-                    spoor_data.append(go.Scattermapbox(
-                        lat=np.array(values['Latitude']),
-                        lon=values['Longitude'],
-                        mode="lines",
-                        line=dict(width=width, color=color),
-                        showlegend=(len(spoor_data) == 1) and show_legend,
-                        legendgroup='spoor',
-                        name='Spoor',
-                        text='Spoor'
-                    ))
-        map_data = ringbaan_data + spoor_data
+        ringbaan, spoor = _load_roads()
+
+        # Every kind of road is drawn as a dark outline with a lighter line on top. All the parts of a kind are in one
+        # trace, a trace per part makes the map a lot slower to draw.
+        map_data = []
+        for lines, colors, legend_group, name in [(ringbaan, ['#444444', "#FCD6A4"], 'ringbaan', 'Ringbaan'),
+                                                  (spoor, ['#555555', '#777777'], 'spoor', 'Spoor')]:
+            for color, width in zip(colors, [4, 2]):
+                map_data.append(go.Scattermapbox(
+                    lat=lines['lat'],
+                    lon=lines['lon'],
+                    mode="lines",
+                    line=dict(width=width, color=color),
+                    showlegend=(width == 2) and show_legend,
+                    legendgroup=legend_group,
+                    name=name,
+                    text=lines['text']))
         self.figure.add_traces(map_data)
 
     def create_standard_choroplethmapbox(self,
@@ -500,14 +522,13 @@ class plolty_gemeente_map_wrapper(object):
         colors <list>
             A list of colors that the function can use the get colors from. If no are given it will use the basic colors of the plotly library
         """
-        grouped_gdf = gdf.groupby([key_column, categorie_column], as_index=False).count()
-        grouped_gdf = grouped_gdf.groupby(key_column, as_index=False).max()
+        # Every region gets the highest of its categories. The order of the regions doesn't matter for the map, so the
+        # groups don't have to be sorted
+        grouped_gdf = gdf.groupby(key_column, as_index=False, sort=False)[categorie_column].max()
+        grouped_gdf = grouped_gdf.dropna(subset=[categorie_column])
 
         # Add the name of the region as text
         name = key_column[:-5] + "_NAAM"
-        # if the name column is allready in the grouped df we drop it (because it still contains the count)
-        if name in grouped_gdf:
-            grouped_gdf.drop(name, axis=1, inplace=True)
         merged_df = grouped_gdf.merge(self.gdf_gemeente, on=key_column)
 
         data = merged_df[categorie_column]
@@ -524,50 +545,55 @@ class plolty_gemeente_map_wrapper(object):
             legend_group_name = legend_group + ": "
         else:
             legend_group_name = ""
+        # The legend items of the categories toggle the choropleth, so they share a legend group with it. This means a
+        # click on one category hides all the categories of the layer, a single category can't be hidden on its own.
+        legend_group_id = legend_group if legend_group is not None else f'categories {categorie_column}'
 
         # If no colors are given use basic colors
         if colors is None:
             colors = basic_colors
 
-        # Create an array with all unique categories in the data
-        unique_categories = np.unique(data)
-
-        for category in unique_categories:
-            assert self.category_count < len(colors), f"There are more categories {len(unique_categories)} than colors " \
-                                                      f"{len(colors)}, so there are no more colors to choose from "
-
-            name = legend_group_name + str(category)
-            # create an index to filter the data. This way we have a sub_data dataset that only contains
-            # data of category we are currently looping over.
-            index = data == category
-            sub_data = data[index]
-            sub_text = text[index]
-            sub_keys = data_key[index]
-
-            # To be able to create a Choroplethmapbox we need float data, so we create an array of 0's per category
-            # These 0's are then plotted with the correct color.
-            fake_sub_data = np.zeros(len(sub_data))
-
-            # Here a custom color scale is created. The scale only has 1 color. So in the end this will mean it visualize
-            # this category with the color we are looping over.
-            custom_scale = [[0, colors[self.category_count]],
-                            [1, colors[self.category_count]]]
-
-            # We create a customhover format so that it only show's the key and category and not the 0 needed for the choroplethmapbox
-            custom_data = [category] * len(sub_data)
-            hover_template = "%{text}<br>%{customdata}"
+        # Create an array with all unique categories in the data, and for every region the index of its category
+        unique_categories, category_index = np.unique(data, return_inverse=True)
+        n_categories = len(unique_categories)
+        # Without categories there is nothing to draw, and plotly doesn't accept an empty color scale
+        if n_categories == 0:
+            return
+
+        # All the categories are drawn in one choropleth, a trace per category makes the map a lot slower to draw. The
+        # color scale has a block of one color per category, z is the index of the category of each region.
+        # Only count up category count when using basic colors
+        use_basic_colors = colors is basic_colors
+        n_colors_needed = self.category_count + (n_categories if use_basic_colors else 1)
+        assert n_colors_needed <= len(colors), f"There are more categories {n_categories} than colors " \
+                                               f"{len(colors)}, so there are no more colors to choose from "
+
+        custom_scale = []
+        legend_stubs = []
+        for i, category in enumerate(unique_categories):
+            color = colors[self.category_count]
+            custom_scale += [[i / n_categories, color], [(i + 1) / n_categories, color]]
+
+            # The choropleth has no legend item per category, so an empty trace is added for every category instead
+            legend_stubs.append(go.Scattermapbox(lat=[None], lon=[None], mode='markers',
+                                                 marker=dict(size=10, color=color), legendgroup=legend_group_id,
+                                                 showlegend=show_legend, name=legend_group_name + str(category),
+                                                 hoverinfo='skip'))
+
+            if use_basic_colors:
+                self.category_count += 1
 
-            map_vis = go.Choroplethmapbox(geojson=self.json_gemeente, locations=sub_keys, z=fake_sub_data,
-                                          featureidkey=id_str_name, legendgroup=legend_group, showlegend=show_legend,
-                                          name=name, hovertemplate=hover_template, text=sub_text,
-                                          customdata=custom_data,
-                                          colorscale=custom_scale, showscale=False, marker_opacity=opacity)
+        # We create a customhover format so that it only show's the key and category and not the index of the category
+        hover_template = "%{text}<br>%{customdata}<extra></extra>"
 
-            self.figure.add_trace(map_vis)
+        map_vis = go.Choroplethmapbox(geojson=self.json_gemeente, locations=data_key,
+                                      z=category_index.astype(np.float32), zmin=-0.5, zmax=n_categories - 0.5,
+                                      featureidkey=id_str_name, legendgroup=legend_group_id, showlegend=False,
+                                      hovertemplate=hover_template, text=text, customdata=data.astype(str),
+                                      colorscale=custom_scale, showscale=False, marker_opacity=opacity)
 
-            # Only count up category count when using basic colors
-            if colors == basic_colors:
-                self.category_count += 1
+        self.figure.add_trace(map_vis)
+        self.figure.add_traces(legend_stubs)
 
     def add_bubble_layer(self,
                          data_key,
@@ -637,37 +663,47 @@ class plolty_gemeente_map_wrapper(object):
         """
         # self.check_length(size, data_key)
 
-        # Data_key has to be a series
-        data_key = pd.Series(data_key)
+        # The keys are only used to look up the middle points, so an array is enough
+        data_key = np.asarray(data_key)
 
-        # Convert the keys (BU/GM/WK) to lon/lat data of the middle points of those keys.
-        middle_points = data_key.apply(
-            lambda x: _find_middle_point(x, self.level, self.gdf_gemeente))
-        lon_data = middle_points.apply(lambda x: x[0])
-        lat_data = middle_points.apply(lambda x: x[1])
+        # Convert the keys (BU/GM/WK) to lon/lat data of the middle points of those keys. The middle points of all the
+        # shapes are calculated once per figure and looked up for all the keys at once. Keys without a shape (like
+        # 'onbekend') get no coordinates.
+        if self.middle_points is None:
+            self.middle_points = _middle_points(self.level, self.gdf_gemeente)
+        middle_points = self.middle_points.reindex(data_key)
+        lon_data = middle_points['lon'].values
+        lat_data = middle_points['lat'].values
+
+        # The sizes are converted to an array once, so the sizes of the borders can be calculated for all bubbles at once
+        size = np.asarray(size, dtype=np.float64)
 
         # Scale size (recommended by: https://plotly.com/python/bubble-maps/)
         # sizeref = 2. * max(size) / (max_size ** 2)
-        sizeref = max(size) / max_size
+        sizeref = size.max() / max_size
+
+        marker = dict(size=size,
+                      sizeref=sizeref,
+                      sizemin=min_size,
+                      color=color,
+                      colorscale=color_scale,
+                      showscale=show_scale,
+                      reversescale=reverse_scale)
+        # The color bar is only given when it's shown
+        if show_scale:
+            marker['colorbar'] = dict(title=color_name, x=1.02 + (0.2 * self.scale_count))
 
         bubble_vis = go.Scattermapbox(lon=lon_data, lat=lat_data,
                                       name=name, showlegend=show_legend,
                                       hovertemplate=hover_template, hoverinfo='text',
                                       text=text,  # hovertext=text,
                                       customdata=custom_data,
-                                      marker=dict(size=size,
-                                                  sizeref=sizeref,
-                                                  sizemin=min_size,
-                                                  color=color,
-                                                  colorbar=dict(title=color_name, x=1.02 + (0.2 * self.scale_count)),
-                                                  colorscale=color_scale,
-                                                  showscale=show_scale,
-                                                  reversescale=reverse_scale),
+                                      marker=marker,
                                       opacity=1
                                       )
 
         bubble_vis_border = go.Scattermapbox(lon=lon_data, lat=lat_data, showlegend=False,
-                                             marker=dict(size=size.apply(lambda x: min(x * 1.2, x + 2)),
+                                             marker=dict(size=np.minimum(size * 1.2, size + 2),
                                                          sizeref=sizeref,
                                                          sizemin=min(min_size * 1.2, min_size + 2),
                                                          color='rgb(10, 10, 10)',
@@ -675,8 +711,173 @@ class plolty_gemeente_map_wrapper(object):
                                              opacity=1,
                                              hoverinfo='skip'
                                              )
-        self.figure.add_trace(bubble_vis_border)
-        self.figure.add_trace(bubble_vis)
+        self.figure.add_traces([bubble_vis_border, bubble_vis])
 
         if show_scale:
             self.scale_count += 1
+
+
+@lru_cache(maxsize=1)
+def _load_roads():
+    """
+    Reads the ring roads and trainrails of Tilburg once per process. Returns the lat, lon and text of the ring roads
+    and of the trainrails. The parts of the roads are joined into one line, separated by None.
+    """
+    filename = os.path.join(THIS_FOLDER, 'datasets', 'Wegen_spoor_Tilburg.json')
+    with open(filename, 'rb') as f:
+        roads = fast_json_loads(f.read())
+
+    ringbaan = dict(lat=[], lon=[], text=[])
+    spoor = dict(lat=[], lon=[], text=[])
+    for key, values in roads.items():
+        if values['Type'] == 'Ringbaan':
+            lines, text = ringbaan, key
+        elif values['Type'] == 'Spoor':
+            lines, text = spoor, 'Spoor'
+        else:
+            continue
+        lines['lat'] += values['Latitude'] + [None]
+        lines['lon'] += values['Longitude'] + [None]
+        lines['text'] += [text] * (len(values['Latitude']) + 1)
+    return ringbaan, spoor
+
+
+def shapes_geojson_url(level):
+    """
+    Returns the url of the geojson of the shapes of a level. The map figures refer to this url instead of containing
+    the geojson, so the browser downloads (and caches) the shapes once instead of with every figure. The url includes
+    the requests_pathname_prefix of the app, so it also works when the app is not served from the root.
+    """
+    return app.get_relative_path(f'/shapes/{level}.geojson')
+
+
+@lru_cache(maxsize=4)
+def background_figure(level):
+    """
+    Creates a figure with the gemeente background, the ringbaan and the spoor. These only depend on the level, so they
+    are made once per level and reused for every map.
+    """
+    figure_wrapper = plolty_gemeente_map_wrapper(title='', gdf_gemeente=get_shapes(level), level=level,
+                                                 json_gemeente=shapes_geojson_url(level))
+    figure_wrapper.add_gemeente_background(opacity=0.35)
+    figure_wrapper.add_ringbaan_and_spoor()
+    return figure_wrapper.figure
+
+
+def add_background(figure, level):
+    """
+    Adds the traces and the mapbox layers of the background of a level (see background_figure) to a figure.
+    """
+    background = background_figure(level)
+    figure.add_traces(list(background.data))
+    figure.update_layout(mapbox_layers=list(background.layout.mapbox.layers))
+
+
+def figure_to_dict(figure):
+    """
+    Converts a figure to a dictionary that only contains json types, so it can be cached and send to the dashboard.
+    With orjson the numpy arrays are written directly, values orjson doesn't know (like timestamps) are handled by the
+    plotly encoder.
+    """
+    if orjson is None:
+        return fast_json_loads(pio.to_json(figure, validate=False))
+    return orjson.loads(orjson.dumps(figure.to_plotly_json(), default=plotly.utils.PlotlyJSONEncoder().default,
+                                     option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+
+
+def map_figure_key(map_layers, all_data, level):
+    """
+    Creates a hashable key of everything that defines a map figure: the level, the settings of all layers and the
+    contents of the datasets used by those layers.
+    """
+    dataset_names = sorted({layer['selected_dataset'] for layer in map_layers.values()})
+    dataset_hashes = tuple(hash(all_data[name]['data']) if name in all_data else None for name in dataset_names)
+    return level, json.dumps(map_layers, sort_keys=True), dataset_hashes
+
+
+def layers_use_datasets(layers, datasets):
+    """
+    Checks if one of the given layers visualizes one of the given datasets. The pages use this to skip a real time
+    update when none of their layers show real time data.
+    """
+    if not datasets:
+        return False
+    return any(layer['selected_dataset'] in datasets for layer in layers.values())
+
+
+class figure_cache(object):
+    """
+    A cache of the serialized figures of earlier callbacks, that is shared by all the callbacks of a page. The size is
+    limited so the server doesn't keep every figure ever made in memory, when it's full the least recently used figure
+    is removed. The callbacks run in multiple threads, so every access is done under a lock.
+
+    Input:
+    size <int>
+        The maximum number of figures in the cache. Default: 16
+    """
+
+    def __init__(self, size=16):
+        self.size = size
+        self._figures = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        Returns the cached value of the key, or None if the key isn't in the cache.
+        """
+        with self._lock:
+            value = self._figures.get(key)
+            if value is not None:
+                self._figures.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """
+        Stores a value in the cache, and removes the least recently used values if the cache is full.
+        """
+        with self._lock:
+            self._figures[key] = value
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.size:
+                self._figures.popitem(last=False)
+
+
+# The aggregation method pandas uses for every aggregate option. Unknown options are aggregated with the mean.
+group_methods = {'mean': 'mean', 'max': 'max', 'min': 'min', 'sum': 'sum', 'frequency': 'count'}
+
+
+def group_values(gdf, groupby_value, group_method, group_to=None):
+    """
+    This functions groups a given geo dataframe with a certain method and then return the dataframe. It's used by the
+    map layers of both map pages.
+    """
+
+    # Only the grouped column is needed. Aggregating all the other columns (like the geometry) is a waste of time.
+    groupby_columns = [groupby_value] if isinstance(groupby_value, str) else list(groupby_value)
+    df = pd.DataFrame(gdf[list(dict.fromkeys(groupby_columns + [group_to]))])
+
+    # Text columns (like the BU/WK/GM codes) only have a few unique values, grouping on categories is a lot faster
+    # than hashing every string
+    text_columns = [c for c in groupby_columns if c != group_to and df[c].dtype == object]
+    for column in text_columns:
+        df[column] = df[column].astype('category')
+
+    method = group_methods.get(group_method, 'mean')
+    if method != 'count':
+        df[group_to] = df[group_to].astype(float)
+
+    grouped_df = df.groupby(groupby_columns, sort=False, observed=True).agg(method).reset_index()
+
+    # Give the grouped text columns their original type back, so the callers get the same columns as before
+    for column in text_columns:
+        grouped_df[column] = grouped_df[column].astype(object)
+
+    return grouped_df
+
+
+def hover_label(name):
+    """
+    Makes a column name safe to use as text in a plotly hover template. The name is chosen by the user, so html in it
+    is escaped and a '%' is written as an html entity, otherwise a name like '%{z}' would be filled in by plotly.
+    """
+    return html.escape(str(name)).replace('%', '&#37;')